@@ -1,32 +1,43 @@
-import re
+# Modules only needed by some games are imported when first used, so that
+# importing adventurelib stays cheap for servers and tests. See
+# test_import_time().
+import os
 import sys
-import inspect
-try:
-    import readline  # noqa: adds readline semantics to input()
-except ImportError:
-    pass
-import textwrap
-import random
-from copy import deepcopy
-try:
-    from shutil import get_terminal_size
-except ImportError:
-    try:
-        from backports.shutil_get_terminal_size import get_terminal_size
-    except ImportError:
-        def get_terminal_size(fallback=(80, 24)):
-            return fallback
+import heapq
+import itertools
+import time
+import weakref
+from collections import Counter, OrderedDict, namedtuple
+from collections.abc import Awaitable
+from contextvars import ContextVar
 
 __version__ = '1.2.1'
+
 __all__ = (
     'when',
     'start',
+    'start_async',
     'Room',
     'Item',
+    'CompactRoom',
+    'CompactItem',
     'Bag',
     'say',
     'set_context',
     'get_context',
+    'get_session',
+    'Session',
+    'serve',
+    'create_server',
+    'load_test',
+    'respond',
+    'respond_stream',
+    'record',
+    'replay',
+    'replay_all',
+    'load_world',
+    'World',
+    'InvalidWorld',
 )
 
 
@@ -47,14 +58,12 @@ def set_context(new_context):
     Set the context to `None` to clear the context.
 
     """
-    global current_context
-    _validate_context(new_context)
-    current_context = new_context
+    get_session().set_context(new_context)
 
 
 def get_context():
     """Get the current command context."""
-    return current_context
+    return get_session().context
 
 
 def _validate_context(context):
@@ -123,6 +132,10 @@ class InvalidDirection(Exception):
     """The direction specified was not pre-declared."""
 
 
+class InvalidWorld(Exception):
+    """A world file passed to ``load_world()`` is not correct."""
+
+
 class Placeholder:
     """Match a word in a command string."""
     def __init__(self, name):
@@ -132,35 +145,85 @@ class Placeholder:
         return self.name.upper()
 
 
-class Room:
-    """A generic room object that can be used by game code."""
+def _copy_bag(bag):
+    """Copy a class-level Bag for a new room.
+
+    Most of these Bags are empty defaults, like ``Room.items = Bag()``; a new
+    Bag is much quicker to make than a deep copy of one.
+
+    """
+    if not bag and type(bag) is Bag and vars(bag).keys() == {'_alias_dict'}:
+        return Bag()
+    from copy import deepcopy
+    return deepcopy(bag)
+
+
+class _Exit:
+    """A direction attribute of rooms, such as ``north``.
+
+    The exit is stored in the room's tuple of exits at the direction's ID.
+
+    """
+    __slots__ = ('name', 'id')
+
+    def __init__(self, name, id):
+        self.name = name
+        self.id = id
+
+    def __get__(self, room, owner=None):
+        if room is None:
+            return None
+        exits = room._exits
+        return exits[self.id] if self.id < len(exits) else None
+
+    def __set__(self, room, value):
+        room._set_exit(self.name, value)
+
+
+class _BaseRoom:
+    """Behaviour shared by Room and CompactRoom."""
+
+    __slots__ = ()
 
     _directions = {}
 
+    #: A small integer for each direction, in the order they were added
+    _direction_ids = {}
+    _direction_names = []
+
+    #: The sorted names of the directions in each exit bitmask
+    _exit_names = {0: ()}
+
+    #: The exits of a room, indexed by direction ID, and a bitmask of which
+    #: of them are set. The tuple is only as long as it needs to be.
+    _exits = ()
+    _exit_mask = 0
+
     @staticmethod
     def add_direction(forward, reverse):
-        """Add a direction."""
+        """Add a direction.
+
+        Adding a direction again with the same opposite does nothing, so
+        that a game can be loaded more than once.
+
+        """
+        if _BaseRoom._directions.get(forward) == reverse:
+            return
         for dir in (forward, reverse):
             if not dir.islower():
                 raise InvalidCommand(
                     'Invalid direction %r: directions must be all lowercase.'
                 )
-            if dir in Room._directions:
+            if dir in _BaseRoom._directions:
                 raise KeyError('%r is already a direction!' % dir)
-        Room._directions[forward] = reverse
-        Room._directions[reverse] = forward
-
-        # Set class attributes to None to act as defaults
-        setattr(Room, forward, None)
-        setattr(Room, reverse, None)
-
-    def __init__(self, description):
-        self.description = description.strip()
+        _BaseRoom._directions[forward] = reverse
+        _BaseRoom._directions[reverse] = forward
 
-        # Copy class Bags to instance variables
-        for k, v in vars(type(self)).items():
-            if isinstance(v, Bag):
-                setattr(self, k, deepcopy(v))
+        ids = _BaseRoom._direction_ids
+        for dir in (forward, reverse):
+            ids[dir] = len(ids)
+            _BaseRoom._direction_names.append(dir)
+            setattr(_BaseRoom, dir, _Exit(dir, ids[dir]))
 
     def __str__(self):
         return self.description
@@ -171,16 +234,25 @@ class Room:
         Return None if the room has no exit in a direction.
 
         """
-        if direction not in self._directions:
+        i = self._direction_ids.get(direction)
+        if i is None:
             raise KeyError('%r is not a direction' % direction)
-        return getattr(self, direction, None)
+        exits = self._exits
+        return exits[i] if i < len(exits) else None
 
     def exits(self):
         """Get a list of directions to exit the room."""
-        return sorted(d for d in self._directions if getattr(self, d))
+        mask = self._exit_mask
+        try:
+            names = self._exit_names[mask]
+        except KeyError:
+            names = self._exit_names[mask] = tuple(sorted(
+                d for d, i in self._direction_ids.items() if mask >> i & 1
+            ))
+        return list(names)
 
     def __setattr__(self, name, value):
-        if isinstance(value, Room):
+        if isinstance(value, _BaseRoom):
             if name not in self._directions:
                 raise InvalidDirection(
                     '%r is not a direction you have declared.\n\n' +
@@ -188,18 +260,76 @@ class Room:
                     ' where <opposite> is the return direction.'
                 )
             reverse = self._directions[name]
-            object.__setattr__(self, name, value)
-            object.__setattr__(value, reverse, self)
+            self._set_exit(name, value)
+            value._set_exit(reverse, self)
         else:
             object.__setattr__(self, name, value)
 
+    def _set_exit(self, direction, room):
+        """Store an exit in the tuple of exits, and update the bitmask.
+
+        Exits change rarely, so the tuple is rebuilt each time.
+
+        """
+        i = self._direction_ids[direction]
+        exits = list(self._exits)
+        if i >= len(exits):
+            exits.extend([None] * (i + 1 - len(exits)))
+        exits[i] = room
+        bit = 1 << i
+        mask = self._exit_mask | bit if room else self._exit_mask & ~bit
+        object.__setattr__(self, '_exits', tuple(exits))
+        object.__setattr__(self, '_exit_mask', mask)
+        for routes in _route_caches:
+            routes._exit_changed(self)
+
+    def path_to(self, other):
+        """Get the shortest list of directions that lead to another room.
+
+        Return an empty list if other is this room, or None if other cannot
+        be reached from here. Routes are cached by ``routes``.
+
+        """
+        return routes.path(self, other)
+
+
+class Room(_BaseRoom):
+    """A generic room object that can be used by game code."""
+
+    def __init__(self, description):
+        self.description = description.strip()
+
+        # Copy class Bags to instance variables
+        for k, v in vars(type(self)).items():
+            if isinstance(v, Bag):
+                setattr(self, k, _copy_bag(v))
+
+
+class CompactRoom(_BaseRoom):
+    """A room that uses less memory than Room, for very large worlds.
+
+    A CompactRoom has no ``__dict__``, so only its description and exits
+    can be set. To store other attributes, or Bags, on rooms, subclass it
+    and list their names in ``__slots__``. Class-level Bags are not copied
+    to each room as they are for Room.
+
+    """
+    __slots__ = ('description', '_exits', '_exit_mask', '__weakref__')
+
+    def __init__(self, description):
+        self.description = description.strip()
+        self._exits = ()
+        self._exit_mask = 0
+
 
 Room.add_direction('north', 'south')
 Room.add_direction('east', 'west')
 
 
-class Item:
-    """A generic item object that can be referred to by a number of names."""
+class _BaseItem:
+    """Behaviour shared by Item and CompactItem."""
+
+    __slots__ = ()
 
     def __init__(self, name, *aliases):
         self.name = name
@@ -218,6 +348,28 @@ class Item:
         return self.name
 
 
+class Item(_BaseItem):
+    """A generic item object that can be referred to by a number of names."""
+
+
+class CompactItem(_BaseItem):
+    """An Item that uses less memory, for games with very many items.
+
+    Like CompactRoom, a CompactItem has no ``__dict__``; subclass it and add
+    ``__slots__`` to store other attributes.
+
+    """
+    __slots__ = ('name', 'aliases')
+
+    def __init__(self, name, *aliases):
+        # Many items share names, so share the strings too
+        self.name = name
+        self.aliases = tuple(
+            sys.intern(label.lower())
+            for label in (name,) + aliases
+        )
+
+
 class Bag(set):
     """A collection of Items, such as in an inventory.
 
@@ -359,7 +511,13 @@ class Bag(set):
         """
         if not self:
             return None
-        which = random.randrange(len(self))
+        session = get_session()
+        if session.random_seed is not None:
+            # Set order depends on the ids of the items, so sort them for a
+            # seed to choose the same item in every process
+            items = sorted(self, key=lambda item: item.aliases)
+            return items[session.random.randrange(len(items))]
+        which = session.random.randrange(len(self))
         for index, obj in enumerate(self):
             if index == which:
                 return obj
@@ -376,275 +534,2630 @@ class Bag(set):
         return obj
 
 
-def _register(command, func, context=None, kwargs=None):
-    """Register func as a handler for the given command."""
-    if kwargs is None:
-        kwargs = {}
-    pattern = Pattern(command, context)
-    sig = inspect.signature(func)
-    func_argnames = set(sig.parameters)
-    when_argnames = set(pattern.argnames) | set(kwargs.keys())
-    if func_argnames != when_argnames:
-        raise InvalidCommand(
-            'The function %s%s has the wrong signature for @when(%r)' % (
-                func.__name__, sig, command
-            ) + '\n\nThe function arguments should be (%s)' % (
-                ', '.join(pattern.argnames + list(kwargs.keys()))
-            )
-        )
+#: Statistics about a cache, as returned by ``parse_cache_info()``.
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
 
-    commands.append((pattern, func, kwargs))
 
+#: Returned by _LRUCache.lookup() if a key is not present.
+_MISSING = object()
 
-class Pattern:
-    """A pattern for matching a command.
 
-    Patterns are defined with a string like 'take ITEM' which corresponds to
-    matching 'take' exactly followed by capturing one or more words as the
-    group named 'item'.
+class _LRUCache(OrderedDict):
+    """A bounded mapping that discards the least recently used entries.
+
+    A `maxsize` of 0 means that nothing will be stored.
+
     """
+    def __init__(self, maxsize=0):
+        super().__init__()
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
 
-    def __init__(self, pattern, context=None):
-        self.orig_pattern = pattern
-        _validate_context(context)
-        self.pattern_context = context
-        words = pattern.split()
-        match = []
-        argnames = []
-        self.placeholders = 0
-        for w in words:
-            if not w.isalpha():
-                raise InvalidCommand(
-                    'Invalid command %r' % pattern +
-                    'Commands may consist of letters only.'
-                )
-            if w.isupper():
-                arg = w.lower()
-                if arg in argnames:
-                    raise InvalidCommand(
-                            'Invalid command %r' % pattern +
-                            ' Identifiers may only be used once'
-                            )
-                argnames.append(arg)
-                match.append(Placeholder(arg))
-                self.placeholders += 1
-            elif w.islower():
-                match.append(w)
-            else:
-                raise InvalidCommand(
-                    'Invalid command %r' % pattern +
-                    '\n\nWords in commands must either be in lowercase or ' +
-                    'capitals, not a mix.'
-                )
-        self.argnames = argnames
-        self.prefix = []
-        for w in match:
-            if isinstance(w, Placeholder):
-                break
-            self.prefix.append(w)
-        self.pattern = match[len(self.prefix):]
-        self.fixed = len(self.pattern) - self.placeholders
+    def lookup(self, key):
+        """Return the value for key, or _MISSING, and count hits/misses."""
+        try:
+            value = self[key]
+        except KeyError:
+            self.misses += 1
+            return _MISSING
+        self.move_to_end(key)
+        self.hits += 1
+        return value
 
-    def __repr__(self):
-        ctx = ''
-        if self.pattern_context:
-            ctx = ', context=%r' % self.pattern_context
-        return '%s(%r%s)' % (
-            type(self).__name__,
-            self.orig_pattern,
-            ctx
-        )
+    def store(self, key, value):
+        """Store a value, discarding the oldest entry if we are full."""
+        self[key] = value
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
 
-    @staticmethod
-    def word_combinations(have, placeholders):
-        """Iterate over possible assignments of words in have to placeholders.
+    def resize(self, maxsize):
+        """Change the maximum size, discarding entries if necessary."""
+        self.maxsize = maxsize
+        while len(self) > maxsize:
+            self.popitem(last=False)
 
-        `have` is the number of words to allocate and `placeholders` is the
-        number of placeholders that those could be distributed to.
+    def info(self):
+        """Return a CacheInfo describing the cache."""
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self))
 
-        Return an iterable of tuples of integers; the length of each tuple
-        will match `placeholders`.
 
-        """
-        if have < placeholders:
-            return
-        if have == placeholders:
-            yield (1,) * placeholders
-            return
-        if placeholders == 1:
-            yield (have,)
-            return
+#: The Routes objects to tell when an exit of a room changes
+_route_caches = weakref.WeakSet()
 
-        # Greedy - start by taking everything
-        other_groups = placeholders - 1
-        take = have - other_groups
-        while take > 0:
-            remain = have - take
-            if have >= placeholders - 1:
-                combos = Pattern.word_combinations(remain, other_groups)
-                for buckets in combos:
-                    yield (take,) + tuple(buckets)
-            take -= 1  # backtrack
 
-    def is_active(self):
-        """Return True if a command is active in the current context."""
-        return _match_context(self.pattern_context, current_context)
+class Routes:
+    """Find shortest paths between rooms, following their exits.
 
-    def ctx_order(self):
-        """Return an integer indicating how nested the context is."""
-        if not self.pattern_context:
-            return 0
-        return self.pattern_context.count(CONTEXT_SEP) + 1
+    A breadth-first search from a room finds the shortest path from it to
+    every room it can reach. The results of the searches from the `maxsize`
+    most recently used starting rooms are kept, so that when the map does
+    not change, routes from those rooms are found without searching.
 
-    def match(self, input_words):
-        """Match a given list of input words against this pattern.
+    When an exit of a room is changed, only the searches that reached that
+    room are discarded. Searches do not keep rooms alive: the search from a
+    room is discarded when the room is freed.
 
-        Return a dict of captured groups if the pattern matches, or None if
-        the pattern does not match.
+    """
+    def __init__(self, maxsize=1024):
+        self._trees = _LRUCache(maxsize)
+        _route_caches.add(self)
 
-        """
-        global current_context
+    def close(self):
+        """Stop caching routes."""
+        _route_caches.discard(self)
+        self._trees.clear()
 
-        if len(input_words) < len(self.argnames):
-            return None
+    def _tree(self, source):
+        """Return {id(room): (id(previous room), direction)} for rooms
+        reachable from source.
 
-        if input_words[:len(self.prefix)] != self.prefix:
-            return None
+        Rooms are stored by id so that the cache does not keep them alive.
+        Every room in a search stays reachable from the source, and so stays
+        alive, until an exit changes and the search is discarded.
+
+        """
+        key = id(source)
+        trees = self._trees
+        entry = trees.lookup(key)
+        if entry is not _MISSING and entry[0]() is source:
+            return entry[1]
+        names = _BaseRoom._direction_names
+        tree = {key: None}
+        frontier = [source]
+        while frontier:
+            next_frontier = []
+            for room in frontier:
+                here = id(room)
+                for i, dest in enumerate(room._exits):
+                    if isinstance(dest, _BaseRoom) and id(dest) not in tree:
+                        tree[id(dest)] = (here, names[i])
+                        next_frontier.append(dest)
+            frontier = next_frontier
+
+        def forget(ref):
+            if trees.get(key, (None,))[0] is ref:
+                del trees[key]
+
+        trees.store(key, (weakref.ref(source, forget), tree))
+        return tree
+
+    def _exit_changed(self, room):
+        """Discard searches that may be changed by an exit of room."""
+        trees = self._trees
+        if trees:
+            key = id(room)
+            stale = [s for s, (_, tree) in trees.items() if key in tree]
+            for source in stale:
+                del trees[source]
+
+    def path(self, source, target):
+        """Get the shortest list of directions from source to target.
+
+        Return None if target cannot be reached from source.
 
-        input_words = input_words[len(self.prefix):]
+        """
+        return self._walk(self._tree(source), target)
 
-        if not input_words and not self.pattern:
-            return {}
-        if bool(input_words) != bool(self.pattern):
+    @staticmethod
+    def _walk(tree, target):
+        """Follow a search tree back from target to get a path to it."""
+        step = tree.get(id(target), False)
+        if step is False:
             return None
+        path = []
+        while step is not None:
+            room, direction = step
+            path.append(direction)
+            step = tree[room]
+        path.reverse()
+        return path
 
-        have = len(input_words) - self.fixed
+    def paths(self, pairs):
+        """Get the shortest paths for many (source, target) pairs at once.
 
-        for combo in self.word_combinations(have, self.placeholders):
-            matches = {}
-            take = iter(combo)
-            inp = iter(input_words)
-            try:
-                for cword in self.pattern:
-                    if isinstance(cword, Placeholder):
-                        count = next(take)
-                        ws = []
-                        for _ in range(count):
-                            ws.append(next(inp))
-                        matches[cword.name] = ws
-                    else:
-                        word = next(inp)
-                        if cword != word:
-                            break
-                else:
-                    return {k: ' '.join(v) for k, v in matches.items()}
-            except StopIteration:
-                continue
-        return None
+        Return a list of paths, as from ``path()``, in the order of pairs.
+        Each starting room is searched from once.
 
+        """
+        pairs = list(pairs)
+        by_source = {}
+        for i, (source, target) in enumerate(pairs):
+            by_source.setdefault(source, []).append((i, target))
+        results = [None] * len(pairs)
+        walk = self._walk
+        for source, targets in by_source.items():
+            tree = self._tree(source)
+            for i, target in targets:
+                results[i] = walk(tree, target)
+        return results
+
+    def distance(self, source, target):
+        """Get the number of moves from source to target, or None."""
+        path = self.path(source, target)
+        return None if path is None else len(path)
+
+    def cache_info(self):
+        """Return a CacheInfo describing the cache of searches."""
+        return self._trees.info()
+
+
+#: The Routes used by ``Room.path_to()``
+routes = Routes()
+
+
+#: A world loaded by ``load_world()``, and how long it took to load
+World = namedtuple(
+    'World',
+    'rooms items bags records seconds records_per_second'
+)
 
-def prompt():
-    """Called to get the prompt text."""
-    return '> '
 
+def load_world(file, room_class=None, item_class=None):
+    """Build rooms, items and bags from a world file.
 
-def no_command_matches(command):
-    """Called when a command is not understood."""
-    print("I don't understand '%s'." % command)
+    `file` is the path of the file, or a file or other iterable of lines.
+    It is read one line at a time, so worlds of any size load in time
+    proportional to their size. Each line is a record:
 
+    * ``direction FORWARD REVERSE`` - call ``Room.add_direction()``, unless
+      the directions already exist.
+    * ``room ID`` - a room; the indented lines that follow are its
+      description.
+    * ``exit ID DIRECTION OTHER`` - set an exit of room ID, and the way back
+      from OTHER. OTHER may be defined later in the file.
+    * ``item ID NAME[, ALIAS...]`` - an item.
+    * ``bag ID`` - an empty Bag.
+    * ``put ITEM WHERE`` - put an item in a bag, or in the ``items`` Bag of
+      a room.
 
-def when(command, context=None, **kwargs):
-    """Decorator for command functions."""
-    def dec(func):
-        _register(command, func, context, kwargs)
-        return func
-    return dec
+    Blank lines and lines starting with ``#`` are ignored.
 
+    Return a World with dicts of the `rooms`, `items` and `bags` by ID, and
+    the number of `records` loaded per second.
 
-def help():
-    """Print a list of the commands you can give."""
-    print('Here is a list of the commands you can give:')
-    cmds = sorted(c.orig_pattern for c, _, _ in commands if c.is_active())
-    for c in cmds:
-        print(c)
+    """
+    if isinstance(file, (str, bytes, os.PathLike)):
+        with open(file, encoding='utf-8') as f:
+            return load_world(f, room_class, item_class)
+    if room_class is None:
+        room_class = Room
+    if item_class is None:
+        item_class = Item
+    rooms = {}
+    items = {}
+    bags = {}
+    deferred = []
+    records = 0
+    room_id = None
+    description = []
+
+    def fail(lineno, msg):
+        raise InvalidWorld('line %d: %s' % (lineno, msg)) from None
+
+    def exit(lineno, args):
+        try:
+            room, direction, other = args
+            setattr(rooms[room], direction, rooms[other])
+        except ValueError:
+            fail(lineno, 'expected exit ID DIRECTION OTHER')
+        except KeyError as e:
+            fail(lineno, 'unknown room %s' % e)
+        except InvalidDirection:
+            fail(lineno, '%r is not a direction' % direction)
+
+    def put(lineno, args):
+        try:
+            item, where = args
+            item = items[item]
+        except ValueError:
+            fail(lineno, 'expected put ITEM WHERE')
+        except KeyError as e:
+            fail(lineno, 'unknown item %s' % e)
+        if where in bags:
+            bag = bags[where]
+        elif where in rooms:
+            room = rooms[where]
+            bag = getattr(room, 'items', None)
+            if not isinstance(bag, Bag):
+                try:
+                    bag = room.items = Bag()
+                except AttributeError:
+                    fail(lineno, 'room %r cannot hold items' % where)
+        else:
+            fail(lineno, 'unknown bag or room %r' % where)
+        bag.add(item)
+
+    def end_room():
+        if room_id is not None:
+            rooms[room_id] = room_class('\n'.join(description))
+            description.clear()
+
+    started = time.perf_counter()
+    for lineno, line in enumerate(file, start=1):
+        if line[:1].isspace():
+            if line.strip():
+                if room_id is None:
+                    fail(lineno, 'description outside a room')
+                description.append(line.strip())
+            continue
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        end_room()
+        room_id = None
+        records += 1
+        kind, _, rest = line.partition(' ')
+        args = rest.split()
+        if kind == 'room':
+            if len(args) != 1:
+                fail(lineno, 'expected room ID')
+            if args[0] in rooms:
+                fail(lineno, 'room %r is already defined' % args[0])
+            room_id = args[0]
+        elif kind == 'exit':
+            if len(args) == 3 and args[0] in rooms and args[2] in rooms:
+                exit(lineno, args)
+            else:
+                deferred.append((exit, lineno, args))
+        elif kind == 'item':
+            id, _, names = rest.partition(' ')
+            names = [n.strip() for n in names.split(',') if n.strip()]
+            if not names:
+                fail(lineno, 'expected item ID NAME[, ALIAS...]')
+            if id in items:
+                fail(lineno, 'item %r is already defined' % id)
+            items[id] = item_class(*names)
+        elif kind == 'bag':
+            if len(args) != 1:
+                fail(lineno, 'expected bag ID')
+            if args[0] in bags:
+                fail(lineno, 'bag %r is already defined' % args[0])
+            bags[args[0]] = Bag()
+        elif kind == 'put':
+            if len(args) == 2 and args[0] in items and (
+                    args[1] in bags or args[1] in rooms):
+                put(lineno, args)
+            else:
+                deferred.append((put, lineno, args))
+        elif kind == 'direction':
+            if len(args) != 2:
+                fail(lineno, 'expected direction FORWARD REVERSE')
+            forward, reverse = args
+            if Room._directions.get(forward) != reverse:
+                try:
+                    Room.add_direction(forward, reverse)
+                except (KeyError, InvalidCommand) as e:
+                    fail(lineno, e.args[0])
+        else:
+            fail(lineno, 'unknown record %r' % kind)
+    end_room()
+    for func, lineno, args in deferred:
+        func(lineno, args)
+    elapsed = time.perf_counter() - started
+    return World(
+        rooms=rooms,
+        items=items,
+        bags=bags,
+        records=records,
+        seconds=elapsed,
+        records_per_second=records / elapsed if elapsed else 0.0,
+    )
 
 
-def _available_commands():
-    """Return the list of available commands in the current context.
+class Stats:
+    """Counters describing where time goes in handling commands.
 
-    The order will be the order in which they should be considered, which
-    corresponds to how deeply nested the context is.
+    Statistics are only collected while enabled with ``enable_stats()``.
 
     """
-    available_commands = []
-    for c in commands:
-        pattern = c[0]
-        if pattern.is_active():
-            available_commands.append(c)
-    available_commands.sort(
-        key=lambda c: c[0].ctx_order(),
-        reverse=True,
-    )
-    return available_commands
+    def __init__(self, hook=None):
+        #: A function called as ``hook(cmd, pattern, seconds)`` after each
+        #: command is handled, eg. to feed an external profiler. `pattern` is
+        #: None if the command was not understood.
+        self.hook = hook
+        self.reset()
+
+    def reset(self):
+        """Set all counters back to zero."""
+        #: The number of commands handled, and how many were not understood
+        self.commands = 0
+        self.unmatched = 0
+
+        #: The number of calls to Pattern.match(), in total and per pattern
+        self.match_attempts = 0
+        self.attempts = Counter()
+
+        #: How many commands took each number of match attempts
+        self.attempts_per_command = Counter()
+
+        #: Seconds spent finding which command matches
+        self.match_time = 0.0
+
+        #: The number of times each pattern matched, and the seconds spent in
+        #: its handler
+        self.hits = Counter()
+        self.handler_time = Counter()
+
+        #: The number of bytes of output written, encoded as UTF-8
+        self.output_bytes = 0
+
+    def record_matches(self, patterns, seconds):
+        """Record the patterns tried to match one command."""
+        self.match_attempts += len(patterns)
+        self.attempts.update(patterns)
+        self.attempts_per_command[len(patterns)] += 1
+        self.match_time += seconds
+
+    def record_command(self, cmd, pattern, seconds):
+        """Record that a command was handled by the handler for pattern."""
+        self.commands += 1
+        if pattern is None:
+            self.unmatched += 1
+        else:
+            self.hits[pattern] += 1
+            self.handler_time[pattern] += seconds
+        if self.hook is not None:
+            self.hook(cmd, pattern, seconds)
+
+    def dump(self, file=None):
+        """Print a report of the statistics to file (default stdout)."""
+        def out(*values):
+            print(*values, file=file)
+
+        out('Commands handled: %d (%d not understood)' % (
+            self.commands, self.unmatched
+        ))
+        lines = sum(self.attempts_per_command.values())
+        out('Match attempts: %d (%.2f per command, at most %d)' % (
+            self.match_attempts,
+            self.match_attempts / max(lines, 1),
+            max(self.attempts_per_command, default=0),
+        ))
+        out('Time matching: %.6fs' % self.match_time)
+        out('Output: %d bytes' % self.output_bytes)
+        if self.attempts:
+            out()
+            out('%-40s %8s %8s %12s' % ('Pattern', 'Hits', 'Attempts', 'Time'))
+            for pattern, attempts in self.attempts.most_common():
+                out('%-40s %8d %8d %11.6fs' % (
+                    repr(pattern)[:40],
+                    self.hits[pattern],
+                    attempts,
+                    self.handler_time[pattern],
+                ))
+
+
+#: The Stats being collected, or None if stats are disabled.
+_stats = None
+
+
+def enable_stats(hook=None):
+    """Start collecting statistics about command handling.
+
+    If `hook` is given, it is called as ``hook(cmd, pattern, seconds)`` after
+    each command is handled.
+
+    Return the Stats object that will be updated.
 
+    """
+    global _stats
+    _stats = Stats(hook)
+    return _stats
 
-def _handle_command(cmd):
-    """Handle a command typed by the user."""
-    ws = cmd.lower().split()
-
-    for pattern, func, kwargs in _available_commands():
-        args = kwargs.copy()
-        matches = pattern.match(ws)
-        if matches is not None:
-            args.update(matches)
-            func(**args)
-            break
-    else:
-        no_command_matches(cmd)
-    print()
 
+def disable_stats():
+    """Stop collecting statistics."""
+    global _stats
+    _stats = None
 
-def start(help=True):
-    """Run the game."""
-    if help:
-        # Ugly, but we want to keep the arguments consistent
-        help = globals()['help']
-        qmark = Pattern('help')
-        qmark.prefix = ['?']
-        qmark.orig_pattern = '?'
-        commands.insert(0, (Pattern('help'), help, {}))
-        commands.insert(0, (qmark, help, {}))
-    while True:
-        try:
-            cmd = input(prompt()).strip()
-        except EOFError:
-            print()
-            break
 
-        if not cmd:
-            continue
+def get_stats():
+    """Return the Stats being collected, or None if they are disabled."""
+    return _stats
 
-        _handle_command(cmd)
 
+class _TrieNode:
+    """A node in the dispatch trie of a CommandTable."""
 
-def say(msg):
-    """Print a message.
+    __slots__ = ('positions', 'children')
 
-    Unlike print(), this deals with de-denting and wrapping of text to fit
-    within the width of the terminal.
+    def __init__(self):
+        self.positions = []
+        self.children = {}
 
-    Paragraphs separated by blank lines in the input will be wrapped
-    separately.
 
-    """
-    msg = str(msg)
-    msg = re.sub(r'^[ \t]*(.*?)[ \t]*$', r'\1', msg, flags=re.M)
-    width = get_terminal_size()[0]
-    paragraphs = re.split(r'\n(?:[ \t]*\n)', msg)
-    formatted = (textwrap.fill(p.strip(), width=width) for p in paragraphs)
-    print('\n\n'.join(formatted))
+class CommandTable(list):
+    """The list of registered commands, indexed for fast dispatch.
 
+    Each entry is a ``(pattern, func, kwargs)`` tuple. Alongside the list we
+    maintain a trie over the literal prefix words of each pattern, so that an
+    input is only tried against patterns whose prefix it starts with, plus the
+    patterns that have no prefix at all.
 
-commands = [
-    (Pattern('quit'), sys.exit, {}),  # quit command is built-in
-]
+    The trie records positions in the list. Appending a command extends it;
+    any other change to the list discards it to be rebuilt on next use.
+
+    With the trie we keep a vocabulary of the literal words in the patterns.
+    Input words are replaced with the vocabulary's interned copies, so that
+    comparing them with pattern words is an identity check, and an input
+    containing an unknown word is not tried against patterns that have no
+    placeholders, as these could never match it.
+
+    We also cache, for each context, the order in which active commands
+    should be considered, and optionally the command that each recent input
+    resolved to. These are discarded whenever the list changes, or by
+    calling ``clear_cache()``.
+
+    A table that is shared between sessions should be frozen with
+    ``freeze()``, after which changing it raises TypeError.
+
+    With ``adapt_order()``, the table counts how often each pattern matches
+    and periodically moves frequently matched patterns earlier, but only
+    past patterns that could never match the same input.
+
+    """
+    frozen = False
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._trie = None
+        self._vocabulary = {}
+        self._by_context = {}
+        self.parse_cache = _LRUCache()
+        self.hits = Counter()
+        self.adapt_interval = 0
+        self._until_adapt = 0
+
+    #######
+    # Dispatch index.
+    #######
+    def _index(self, position, command):
+        """Add the command at the given position to the trie.
+
+        A pattern with alternative or optional words in its prefix is added
+        under every sequence of words that could begin a match.
+
+        """
+        pattern = command[0]
+        for prefix in set(pattern.prefixes()):
+            node = self._trie
+            for word in prefix:
+                child = node.children.get(word)
+                if child is None:
+                    child = node.children[word] = _TrieNode()
+                node = child
+            node.positions.append(position)
+        vocabulary = self._vocabulary
+        for word in pattern.literals():
+            vocabulary.setdefault(word, sys.intern(word))
+
+    def _build_index(self):
+        """Build the trie and vocabulary if they have been discarded."""
+        if self._trie is None:
+            self._trie = _TrieNode()
+            self._vocabulary = {}
+            for position, command in enumerate(self):
+                self._index(position, command)
+
+    def _check_frozen(self):
+        if self.frozen:
+            raise TypeError('This CommandTable is frozen')
+
+    def freeze(self):
+        """Prevent any further changes to the table."""
+        self._build_index()  # now, rather than on first use
+        self.frozen = True
+
+    def copy(self):
+        """Return an unfrozen copy of the table, with the same settings."""
+        table = type(self)(self)
+        table.parse_cache.maxsize = self.parse_cache.maxsize
+        if self.adapt_interval:
+            table.adapt_order(self.adapt_interval)
+        return table
+
+    def _invalidate(self):
+        self._trie = None
+        self._by_context.clear()
+        self.parse_cache.clear()
+
+    def clear_cache(self):
+        """Discard the dispatch index and cached per-context orderings."""
+        self._invalidate()
+
+    def active(self, context):
+        """Return the commands that are active in the given context.
+
+        Return a tuple ``(order, rank)`` where `order` is a list of positions
+        in the order they should be considered, which corresponds to how
+        deeply nested the context is, and `rank` maps each of those
+        positions to its index in `order`.
+
+        """
+        try:
+            return self._by_context[context]
+        except KeyError:
+            pass
+        order = [
+            i for i, (pattern, _, _) in enumerate(self)
+            if _match_context(pattern.pattern_context, context)
+        ]
+        order.sort(key=lambda i: -self[i][0].ctx_order())
+        if self.adapt_interval:
+            order = self._adapted(order)
+        rank = {position: r for r, position in enumerate(order)}
+        self._by_context[context] = order, rank
+        return order, rank
+
+    def adapt_order(self, interval=1000):
+        """Reorder patterns by how often they match, every `interval` hits.
+
+        An interval of 0 stops adapting and restores registration order.
+
+        """
+        self.adapt_interval = self._until_adapt = interval
+        self._by_context.clear()
+
+    def _hit(self, pattern):
+        """Count a hit for pattern, and reorder if it is time."""
+        self.hits[pattern] += 1
+        self._until_adapt -= 1
+        if self._until_adapt <= 0:
+            self._until_adapt = self.adapt_interval
+            self._by_context.clear()
+
+    def _adapted(self, order):
+        """Reorder positions so that frequently matched patterns come first.
+
+        Patterns are only reordered within a tier of the same context depth,
+        and a pattern never moves ahead of an earlier one that it may
+        overlap with, so the same command always wins for any input.
+
+        """
+        tiers = OrderedDict()
+        for i in order:
+            tiers.setdefault(self[i][0].ctx_order(), []).append(i)
+        result = []
+        for tier in tiers.values():
+            result.extend(self._adapted_tier(tier))
+        return result
+
+    def _adapted_tier(self, tier):
+        """Topologically sort a tier of positions, preferring the most hits.
+
+        Patterns can only overlap if their prefixes agree, so we only need to
+        compare patterns with the same first word, and patterns with no
+        prefix against everything.
+
+        """
+        patterns = [self[i][0] for i in tier]
+        by_word = {}
+        for n, pattern in enumerate(patterns):
+            firsts = {prefix[0] if prefix else None
+                      for prefix in pattern.prefixes()}
+            if None in firsts:
+                firsts = {None}
+            for word in firsts:
+                by_word.setdefault(word, []).append(n)
+        unprefixed = by_word.get(None, [])
+        unprefixed_set = set(unprefixed)
+
+        blockers = [0] * len(tier)
+        blocks = [[] for _ in tier]
+
+        def order(a, b):
+            if a > b:
+                a, b = b, a
+            if patterns[a].may_overlap(patterns[b]):
+                blocks[a].append(b)
+                blockers[b] += 1
+
+        for group in by_word.values():
+            for x, a in enumerate(group):
+                for b in group[x + 1:]:
+                    order(a, b)
+        for a in unprefixed:
+            for b in range(len(patterns)):
+                if b not in unprefixed_set:
+                    order(a, b)
+
+        ready = [
+            (-self.hits[patterns[n]], n)
+            for n in range(len(tier)) if not blockers[n]
+        ]
+        heapq.heapify(ready)
+        result = []
+        while ready:
+            _, n = heapq.heappop(ready)
+            result.append(tier[n])
+            for b in blocks[n]:
+                blockers[b] -= 1
+                if not blockers[b]:
+                    heapq.heappush(ready, (-self.hits[patterns[b]], b))
+        return result
+
+    def resolve(self, words, context):
+        """Find the command to run for the given input words in a context.
+
+        Return a tuple ``(pattern, func, args)``, or None if no command
+        matches.
+
+        Only active commands whose literal prefix matches are tried, in the
+        order given by ``active()``. If the parse cache is enabled, the
+        result is remembered for the same context and words.
+
+        """
+        stats = _stats
+        if stats is not None:
+            started = time.perf_counter()
+        words, unknown = self.tokenize(words)
+        cache = self.parse_cache
+        if cache.maxsize:
+            key = (context, tuple(words))
+            result = cache.lookup(key)
+            if result is not _MISSING:
+                if stats is not None:
+                    stats.record_matches((), time.perf_counter() - started)
+                if result is not None:
+                    # Callers may change the args, so don't hand out ours
+                    pattern, func, args = result
+                    result = pattern, func, dict(args)
+                return result
+
+        order, rank = self.active(context)
+        ranks = sorted({rank[i] for i in self.candidates(words) if i in rank})
+        if unknown:
+            ranks = [r for r in ranks if self[order[r]][0].placeholders]
+        result = None
+        attempts = 0
+        for attempts, r in enumerate(ranks, 1):
+            pattern, func, kwargs = self[order[r]]
+            matches = pattern.match(words)
+            if matches is not None:
+                args = kwargs.copy()
+                args.update(matches)
+                result = pattern, func, args
+                if self.adapt_interval:
+                    self._hit(pattern)
+                break
+
+        if cache.maxsize:
+            cache.store(key, result)
+            if result is not None:
+                result = pattern, func, dict(args)
+        if stats is not None:
+            stats.record_matches(
+                [self[order[r]][0] for r in ranks[:attempts]],
+                time.perf_counter() - started
+            )
+        return result
+
+    def candidates(self, words):
+        """Return positions of the commands whose prefix matches words.
+
+        Positions are grouped by prefix length, shortest first, and may be
+        repeated if a pattern has optional words; callers are responsible for
+        ordering them by precedence.
+
+        """
+        self._build_index()
+        node = self._trie
+        found = list(node.positions)
+        for word in words:
+            node = node.children.get(word)
+            if node is None:
+                break
+            found.extend(node.positions)
+        return found
+
+    def tokenize(self, words):
+        """Replace input words with their interned copies in the vocabulary.
+
+        Return the new list of words, and whether any word was not in the
+        vocabulary.
+
+        """
+        self._build_index()
+        vocabulary = self._vocabulary
+        tokens = []
+        unknown = False
+        for word in words:
+            token = vocabulary.get(word)
+            if token is None:
+                unknown = True
+                token = word
+            tokens.append(token)
+        return tokens, unknown
+
+    #######
+    # Implementations of base list interface.
+    #######
+    def append(self, command):
+        self._check_frozen()
+        super().append(command)
+        self._by_context.clear()
+        self.parse_cache.clear()
+        if self._trie is not None:
+            self._index(len(self) - 1, command)
+
+    def extend(self, commands):
+        for command in commands:
+            self.append(command)
+
+    def __iadd__(self, commands):
+        self.extend(commands)
+        return self
+
+    def insert(self, index, command):
+        self._check_frozen()
+        super().insert(index, command)
+        self._invalidate()
+
+    def remove(self, command):
+        self._check_frozen()
+        super().remove(command)
+        self._invalidate()
+
+    def pop(self, *args):
+        self._check_frozen()
+        result = super().pop(*args)
+        self._invalidate()
+        return result
+
+    def clear(self):
+        self._check_frozen()
+        super().clear()
+        self._invalidate()
+
+    def sort(self, *args, **kwargs):
+        self._check_frozen()
+        super().sort(*args, **kwargs)
+        self._invalidate()
+
+    def reverse(self):
+        self._check_frozen()
+        super().reverse()
+        self._invalidate()
+
+    def __setitem__(self, index, value):
+        self._check_frozen()
+        super().__setitem__(index, value)
+        self._invalidate()
+
+    def __delitem__(self, index):
+        self._check_frozen()
+        super().__delitem__(index)
+        self._invalidate()
+
+    def __imul__(self, n):
+        self._check_frozen()
+        result = super().__imul__(n)
+        self._invalidate()
+        return result
+
+
+def _register(command, func, context=None, kwargs=None, table=None):
+    """Register func as a handler for the given command.
+
+    The command is added to `table`, or to the module's `commands` if that
+    is None.
+
+    """
+    if kwargs is None:
+        kwargs = {}
+    if table is None:
+        table = commands
+
+    cache = _command_cache
+    if cache is not None:
+        pattern = cache.get(command, func, context, kwargs)
+        if pattern is not None:
+            table.append((pattern, func, kwargs))
+            return
+
+    import inspect
+    pattern = Pattern(command, context)
+    sig = inspect.signature(func)
+    func_argnames = set(sig.parameters)
+    when_argnames = set(pattern.argnames) | set(kwargs.keys())
+    if func_argnames != when_argnames:
+        raise InvalidCommand(
+            'The function %s%s has the wrong signature for @when(%r)' % (
+                func.__name__, sig, command
+            ) + '\n\nThe function arguments should be (%s)' % (
+                ', '.join(pattern.argnames + list(kwargs.keys()))
+            )
+        )
+
+    if cache is not None:
+        cache.put(command, func, context, kwargs, pattern)
+    table.append((pattern, func, kwargs))
+
+
+# Flags of code objects, as defined in the inspect module
+_CO_VARARGS = 0x04
+_CO_VARKEYWORDS = 0x08
+
+
+class _CommandCache:
+    """Compiled patterns for commands, that can be saved to a file.
+
+    Entries are keyed by the pattern, its context, the qualified name of the
+    handler and the names of extra keyword arguments. Each records a
+    fingerprint of the handler's parameters, so that if these change, the
+    command is compiled and checked again.
+
+    """
+    VERSION = 1
+
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+        self.used = {}
+
+    @staticmethod
+    def _key(command, func, context, kwargs):
+        return (
+            command,
+            context,
+            getattr(func, '__module__', None),
+            getattr(func, '__qualname__', None),
+            tuple(sorted(kwargs)),
+        )
+
+    @staticmethod
+    def fingerprint(func):
+        """Return a value that changes if func's parameters change.
+
+        Return None if we cannot tell, for example for builtins or
+        functions wrapped by other decorators.
+
+        """
+        if hasattr(func, '__wrapped__'):
+            return None
+        code = getattr(func, '__code__', None)
+        if code is None:
+            return None
+        flags = code.co_flags & (_CO_VARARGS | _CO_VARKEYWORDS)
+        nargs = code.co_argcount + code.co_kwonlyargcount
+        nargs += bool(flags & _CO_VARARGS)
+        nargs += bool(flags & _CO_VARKEYWORDS)
+        return flags, code.co_varnames[:nargs]
+
+    def get(self, command, func, context, kwargs):
+        """Return the cached Pattern for a command, or None."""
+        key = self._key(command, func, context, kwargs)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != self.fingerprint(func):
+            return None
+        self.used[key] = entry
+        return entry[1]
+
+    def put(self, command, func, context, kwargs, pattern):
+        """Store a Pattern that has been checked against func."""
+        fingerprint = self.fingerprint(func)
+        if fingerprint is not None:
+            key = self._key(command, func, context, kwargs)
+            self.used[key] = self.entries[key] = fingerprint, pattern
+
+    @classmethod
+    def load(cls, path):
+        """Load a cache from a file, or return an empty one if we can't."""
+        import pickle
+        try:
+            with open(path, 'rb') as f:
+                version, entries = pickle.load(f)
+        except Exception:
+            return cls()
+        if version != (cls.VERSION, __version__):
+            return cls()
+        return cls(entries)
+
+    def save(self, path):
+        """Save the entries used since loading to a file."""
+        import pickle
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(
+                ((self.VERSION, __version__), self.used),
+                f,
+                pickle.HIGHEST_PROTOCOL
+            )
+        os.replace(tmp, path)
+
+
+#: The cache of compiled commands, if loaded with load_command_cache()
+_command_cache = None
+
+
+def load_command_cache(path):
+    """Use compiled commands saved in a file by save_command_cache().
+
+    Call this before defining commands with ``@when``. Commands whose pattern
+    and function parameters are unchanged since the file was saved are not
+    compiled or checked again. If the file is missing or out of date, all
+    commands are compiled as normal.
+
+    The file is loaded with :mod:`pickle`, so only load files that you
+    saved yourself.
+
+    """
+    global _command_cache
+    _command_cache = _CommandCache.load(path)
+
+
+def save_command_cache(path):
+    """Save the compiled commands to a file for load_command_cache().
+
+    Only commands defined since load_command_cache() was called are saved.
+
+    """
+    if _command_cache is None:
+        raise ValueError('Call load_command_cache() before defining commands')
+    _command_cache.save(path)
+
+
+class Alternatives(frozenset):
+    """A set of words, any of which may appear at one place in a pattern.
+
+    Alternatives compare equal to any word they contain, and to any other
+    Alternatives that they share a word with, so they can be compared with
+    input words just like a single literal word.
+
+    """
+    def __eq__(self, other):
+        if isinstance(other, str):
+            return other in self
+        if isinstance(other, frozenset):
+            return not self.isdisjoint(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+
+    __hash__ = frozenset.__hash__
+
+    def __repr__(self):
+        return '|'.join(sorted(self))
+
+
+def _intern(w):
+    """Intern the literal words of w, which may be a Placeholder."""
+    if isinstance(w, str):
+        return sys.intern(w)
+    if isinstance(w, Alternatives):
+        return Alternatives(map(sys.intern, w))
+    return w
+
+
+def _words(literal):
+    """Return the words that a literal in a pattern may match."""
+    if isinstance(literal, str):
+        return (literal,)
+    return sorted(literal)
+
+
+class Pattern:
+    """A pattern for matching a command.
+
+    Patterns are defined with a string like 'take ITEM' which corresponds to
+    matching 'take' exactly followed by capturing one or more words as the
+    group named 'item'.
+
+    Lowercase words may be given as alternatives, like 'take|get ITEM', and
+    may be made optional by putting them in brackets, like 'look [at] THING'.
+    A pattern with optional words matches as if it had been written out
+    in full with and without each of them, trying the fullest first.
+    """
+
+    def __init__(self, pattern, context=None):
+        self.orig_pattern = pattern
+        _validate_context(context)
+        self.pattern_context = context
+        words = pattern.split()
+        match = []
+        optional = []
+        argnames = []
+        self.placeholders = 0
+        for w in words:
+            is_optional = w.startswith('[') and w.endswith(']')
+            if is_optional:
+                w = w[1:-1]
+            alternatives = w.split('|')
+            if not all(a.isalpha() for a in alternatives):
+                raise InvalidCommand(
+                    'Invalid command %r' % pattern +
+                    'Commands may consist of letters only.'
+                )
+            if w.isupper():
+                if is_optional or len(alternatives) > 1:
+                    raise InvalidCommand(
+                        'Invalid command %r' % pattern +
+                        '\n\nOnly lowercase words may be optional or ' +
+                        'have alternatives.'
+                    )
+                arg = w.lower()
+                if arg in argnames:
+                    raise InvalidCommand(
+                            'Invalid command %r' % pattern +
+                            ' Identifiers may only be used once'
+                            )
+                argnames.append(arg)
+                match.append(Placeholder(arg))
+                self.placeholders += 1
+            elif w.islower():
+                if len(alternatives) > 1:
+                    match.append(Alternatives(map(sys.intern, alternatives)))
+                else:
+                    match.append(sys.intern(w))
+                if is_optional:
+                    optional.append(len(match) - 1)
+            else:
+                raise InvalidCommand(
+                    'Invalid command %r' % pattern +
+                    '\n\nWords in commands must either be in lowercase or ' +
+                    'capitals, not a mix.'
+                )
+        self.argnames = argnames
+        self._setup(match)
+
+        #: Patterns for each way of including optional words, or None
+        self.variants = None
+        if optional:
+            variants = []
+            for omit in itertools.product((False, True), repeat=len(optional)):
+                omitted = {i for i, o in zip(optional, omit) if o}
+                variant = Pattern.__new__(Pattern)
+                variant.__dict__.update(self.__dict__)
+                variant._setup([
+                    w for i, w in enumerate(match) if i not in omitted
+                ])
+                variants.append(variant)
+            self.variants = variants
+
+    def __setstate__(self, state):
+        """Restore a pickled pattern, interning its words again."""
+        self.__dict__.update(state)
+        self._setup([_intern(w) for w in self.prefix + self.pattern])
+
+    def _setup(self, match):
+        """Compile the list of placeholders and literals to match."""
+        self.prefix = []
+        for w in match:
+            if isinstance(w, Placeholder):
+                break
+            self.prefix.append(w)
+        self.pattern = match[len(self.prefix):]
+        self.fixed = len(self.pattern) - self.placeholders
+        self._segments = self._compile(self.pattern)
+
+    def prefixes(self):
+        """Iterate over the sequences of words that can begin a match."""
+        for variant in self.variants or (self,):
+            yield from itertools.product(*map(_words, variant.prefix))
+
+    def literals(self):
+        """Iterate over the literal words that appear in this pattern."""
+        for variant in self.variants or (self,):
+            for literal in variant.prefix:
+                yield from _words(literal)
+            for _, literals, _ in variant._segments:
+                for literal in literals:
+                    yield from _words(literal)
+
+    @staticmethod
+    def _compile(pattern):
+        """Compile the words after the prefix into a tuple of segments.
+
+        Each segment is a placeholder followed by the (possibly empty) run of
+        literal words up to the next placeholder. Segments are stored as
+        ``(name, literals, lowest)``, where `lowest` is the earliest offset
+        after the prefix at which the literals could start, allowing one word
+        for each placeholder up to and including this one.
+
+        """
+        segments = []
+        for i, w in enumerate(pattern):
+            if isinstance(w, Placeholder):
+                segments.append((w.name, [], i + 1))
+            else:
+                segments[-1][1].append(w)
+        return tuple(
+            (name, tuple(literals), lowest)
+            for name, literals, lowest in segments
+        )
+
+    def __repr__(self):
+        ctx = ''
+        if self.pattern_context:
+            ctx = ', context=%r' % self.pattern_context
+        return '%s(%r%s)' % (
+            type(self).__name__,
+            self.orig_pattern,
+            ctx
+        )
+
+    @staticmethod
+    def word_combinations(have, placeholders):
+        """Iterate over possible assignments of words in have to placeholders.
+
+        `have` is the number of words to allocate and `placeholders` is the
+        number of placeholders that those could be distributed to.
+
+        Return an iterable of tuples of integers; the length of each tuple
+        will match `placeholders`.
+
+        """
+        if have < placeholders:
+            return
+        if have == placeholders:
+            yield (1,) * placeholders
+            return
+        if placeholders == 1:
+            yield (have,)
+            return
+
+        # Greedy - start by taking everything
+        other_groups = placeholders - 1
+        take = have - other_groups
+        while take > 0:
+            remain = have - take
+            if have >= placeholders - 1:
+                combos = Pattern.word_combinations(remain, other_groups)
+                for buckets in combos:
+                    yield (take,) + tuple(buckets)
+            take -= 1  # backtrack
+
+    def may_overlap(self, other):
+        """Return False if no input could match both this and other.
+
+        This is conservative: it only compares literal prefixes and the
+        number of words each pattern can match.
+
+        """
+        if self.variants is not None or other.variants is not None:
+            return any(
+                a.may_overlap(b)
+                for a in self.variants or (self,)
+                for b in other.variants or (other,)
+            )
+        for a, b in zip(self.prefix, other.prefix):
+            if a != b:
+                return False
+        lengths = []
+        for p in (self, other):
+            shortest = len(p.prefix) + len(p.pattern)
+            longest = float('inf') if p.pattern else shortest
+            lengths.append((shortest, longest))
+        (amin, amax), (bmin, bmax) = lengths
+        return max(amin, bmin) <= min(amax, bmax)
+
+    def is_active(self):
+        """Return True if a command is active in the current context."""
+        return _match_context(self.pattern_context, get_context())
+
+    def ctx_order(self):
+        """Return an integer indicating how nested the context is."""
+        if not self.pattern_context:
+            return 0
+        return self.pattern_context.count(CONTEXT_SEP) + 1
+
+    def match(self, input_words):
+        """Match a given list of input words against this pattern.
+
+        Return a dict of captured groups if the pattern matches, or None if
+        the pattern does not match.
+
+        The result is the same as trying each of ``word_combinations()`` in
+        turn, which gives each placeholder as many words as possible, from
+        left to right. Rather than enumerating combinations, we find the
+        latest position of each run of literal words working from the right;
+        the span between consecutive runs is then the greedy capture.
+
+        """
+        if self.variants is not None:
+            for variant in self.variants:
+                matches = variant.match(input_words)
+                if matches is not None:
+                    return matches
+            return None
+
+        prefix = self.prefix
+        start = len(prefix)
+        n = len(input_words)
+        if n < start:
+            return None
+        for i in range(start):
+            if input_words[i] != prefix[i]:
+                return None
+
+        segments = self._segments
+        if not segments:
+            return {} if n == start else None
+
+        matches = {}
+        last = len(segments) - 1
+        end = n  # the literals of this segment must finish by here
+        following = None  # the name of the placeholder after this segment
+        for i in range(last, -1, -1):
+            name, literals, lowest = segments[i]
+            nlit = len(literals)
+            k = end - nlit
+            lowest += start
+            # Find the latest occurrence of the literals no earlier than
+            # `lowest`; trailing literals must finish the input exactly.
+            while k >= lowest:
+                for j in range(nlit):
+                    if input_words[k + j] != literals[j]:
+                        break
+                else:
+                    break
+                if i == last:
+                    return None
+                k -= 1
+            else:
+                return None
+            if following is not None:
+                matches[following] = ' '.join(input_words[k + nlit:end + 1])
+            following = name
+            end = k - 1  # leave at least one word for this placeholder
+        matches[following] = ' '.join(input_words[start:end + 1])
+        return matches
+
+
+def prompt():
+    """Called to get the prompt text."""
+    return '> '
+
+
+def no_command_matches(command):
+    """Called when a command is not understood."""
+    get_session().print(
+        "I don't understand '%s'." % command, kind='no_match')
+
+
+def when(command, context=None, **kwargs):
+    """Decorator for command functions."""
+    def dec(func):
+        _register(command, func, context, kwargs)
+        return func
+    return dec
+
+
+def help():
+    """Print a list of the commands you can give."""
+    session = get_session()
+    session.print('Here is a list of the commands you can give:', kind='help')
+    table = session.commands
+    order, _ = table.active(session.context)
+    cmds = sorted(table[i][0].orig_pattern for i in order)
+    for c in cmds:
+        session.print(c, kind='help')
+
+
+def _available_commands():
+    """Return the list of available commands in the current context.
+
+    The order will be the order in which they should be considered, which
+    corresponds to how deeply nested the context is.
+
+    """
+    session = get_session()
+    table = session.commands
+    order, _ = table.active(session.context)
+    return [table[i] for i in order]
+
+
+def _handle_command(cmd):
+    """Handle a command typed by the user, returning its Response."""
+    return get_session().handle(cmd)
+
+
+def respond(cmd):
+    """Handle a command in the current session and return a Response.
+
+    The output of the command is not printed, but is returned as the
+    ``output`` of the Response.
+
+    """
+    return get_session().respond(cmd)
+
+
+def respond_stream(lines):
+    """Handle lines of commands in the current session, yielding Responses.
+
+    See ``Session.respond_stream()``.
+
+    """
+    return get_session().respond_stream(lines)
+
+
+def record(file, seed=None):
+    """Start recording the game to a transcript file.
+
+    See ``Session.record()``.
+
+    """
+    get_session().record(file, seed)
+
+
+def set_adaptive_ordering(interval=1000):
+    """Try frequently used commands first.
+
+    Every `interval` matched commands, commands are reordered by how often
+    they have matched, where this cannot change which command any input
+    runs. An interval of 0, the default, disables this.
+
+    """
+    commands.adapt_order(interval)
+
+
+def set_parse_cache_size(maxsize):
+    """Set how many recently typed commands to remember the parse of.
+
+    Repeated commands then skip pattern matching entirely. A size of 0, the
+    default, disables the cache.
+
+    """
+    commands.parse_cache.resize(maxsize)
+
+
+def parse_cache_info():
+    """Return a CacheInfo of hits, misses and size for the parse cache."""
+    return commands.parse_cache.info()
+
+
+def start(help=True):
+    """Run the game."""
+    _default_session.start(help)
+
+
+def start_async(reader=None, help=True):
+    """Run the game in an asyncio event loop.
+
+    This returns a coroutine, so call it like this::
+
+        asyncio.run(start_async())
+
+    Commands are read from `reader`, an asyncio StreamReader, or standard
+    input if that is None. Command functions may be coroutines, written
+    with ``async def``; they are awaited without blocking the event loop.
+
+    """
+    return _default_session.start_async(reader, help)
+
+
+def say(msg):
+    """Print a message.
+
+    Unlike print(), this deals with de-denting and wrapping of text to fit
+    within the width of the terminal.
+
+    Paragraphs separated by blank lines in the input will be wrapped
+    separately.
+
+    """
+    get_session().say(msg)
+
+
+def get_terminal_size(fallback=(80, 24)):
+    """Get the size of the terminal, as shutil.get_terminal_size()."""
+    from shutil import get_terminal_size
+    return get_terminal_size(fallback)
+
+
+#: The width of the terminal while start() is running, kept up to date by a
+#: SIGWINCH handler; None if it must be looked up on each call to say().
+_terminal_width = None
+
+
+def _track_terminal_width():
+    """Cache the terminal width, updating it when the terminal is resized.
+
+    Return a function that stops tracking it, or None if we can't track it
+    (for example on Windows or outside the main thread).
+
+    """
+    import signal
+    import threading
+    if not hasattr(signal, 'SIGWINCH'):
+        return None
+    if threading.current_thread() is not threading.main_thread():
+        return None
+
+    def resized(signum, frame):
+        global _terminal_width
+        _terminal_width = get_terminal_size()[0]
+
+    previous = signal.signal(signal.SIGWINCH, resized)
+    resized(None, None)
+
+    def stop():
+        global _terminal_width
+        signal.signal(signal.SIGWINCH, previous)
+        _terminal_width = None
+    return stop
+
+
+#: Messages recently formatted by say(), keyed by (text, width)
+_say_cache = _LRUCache(256)
+
+#: Compiled regular expressions for say(), once it has been called
+_say_regexes = None
+
+#: TextWrapper objects for each width that say() has wrapped to
+_wrappers = {}
+
+
+def _format(msg, width):
+    """Dedent and wrap a message for say(), remembering recent results."""
+    msg = str(msg)
+    if not _say_cache.maxsize:
+        return _wrap(msg, width)
+    key = (msg, width)
+    formatted = _say_cache.lookup(key)
+    if formatted is _MISSING:
+        formatted = _wrap(msg, width)
+        _say_cache.store(key, formatted)
+    return formatted
+
+
+def _wrap(msg, width):
+    """Dedent and wrap a message for say()."""
+    global _say_regexes
+    if _say_regexes is None:
+        import re
+        _say_regexes = (
+            re.compile(r'^[ \t]*(.*?)[ \t]*$', flags=re.M),
+            re.compile(r'\n(?:[ \t]*\n)'),
+        )
+    strip, paragraph_break = _say_regexes
+    wrapper = _wrappers.get(width)
+    if wrapper is None:
+        import textwrap
+        wrapper = _wrappers[width] = textwrap.TextWrapper(width=width)
+
+    msg = strip.sub(r'\1', msg)
+    paragraphs = paragraph_break.split(msg)
+    return '\n\n'.join(wrapper.fill(p.strip()) for p in paragraphs)
+
+
+def set_say_cache_size(maxsize):
+    """Set how many formatted messages say() should remember.
+
+    A size of 0 disables the cache.
+
+    """
+    _say_cache.resize(maxsize)
+
+
+def say_cache_info():
+    """Return a CacheInfo of hits, misses and size for say()'s cache."""
+    return _say_cache.info()
+
+
+Message = namedtuple('Message', 'kind text')
+
+
+class Response(namedtuple('Response', (
+        'command pattern func args output context_before context_after '
+        'elapsed'))):
+    """The result of handling a command.
+
+    `pattern`, `func` and `args` are the matched Pattern, the function that
+    was called and the arguments it was called with; `pattern` and `func`
+    are None if the command was not understood. `output` is a list of the
+    Messages printed. `elapsed` is the time taken in seconds.
+
+    """
+    __slots__ = ()
+
+    @property
+    def text(self):
+        """All of the output as one string."""
+        return ''.join(m.text for m in self.output)
+
+
+class Output:
+    """Where a Session sends what it prints.
+
+    Text written while a command is being handled is kept in a buffer and
+    sent with one call to ``send()`` when ``flush()`` is called, which the
+    session does once the command's response is complete. Subclasses
+    implement ``send()``.
+
+    `kind` says what the text is: ``'say'``, ``'print'``, ``'help'``,
+    ``'no_match'`` or ``'prompt'``. It is ignored unless a subclass wants
+    it, as MessageOutput does.
+
+    """
+    def __init__(self):
+        self.buffer = []
+
+    def write(self, text, kind='print'):
+        self.buffer.append(text)
+        return len(text)
+
+    def flush(self):
+        if self.buffer:
+            text = ''.join(self.buffer)
+            self.buffer.clear()
+            self.send(text)
+
+    def send(self, text):
+        raise NotImplementedError
+
+
+class StreamOutput(Output):
+    """Send output to a file-like object, or None for ``sys.stdout``.
+
+    ``sys.stdout`` is looked up each time output is sent, so that
+    ``contextlib.redirect_stdout()`` works.
+
+    """
+    def __init__(self, stream=None):
+        super().__init__()
+        self.stream = stream
+
+    def send(self, text):
+        stream = self.stream
+        if stream is None:
+            stream = sys.stdout
+        stream.write(text)
+        stream.flush()
+
+
+class StringOutput(Output):
+    """Keep output in memory."""
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    def send(self, text):
+        self.sent.append(text)
+
+    def getvalue(self):
+        """Return all the text that has been sent."""
+        return ''.join(self.sent)
+
+
+class SocketOutput(Output):
+    """Send output to a connected socket.
+
+    Newlines are translated to CRLF, as telnet clients expect.
+
+    """
+    def __init__(self, sock, encoding='utf-8'):
+        super().__init__()
+        self.sock = sock
+        self.encoding = encoding
+
+    def send(self, text):
+        self.sock.sendall(text.replace('\n', '\r\n').encode(self.encoding))
+
+
+class MessageOutput(Output):
+    """Keep output as a list of Message(kind, text) tuples.
+
+    Each call to ``say()``, ``print()`` and so on makes one message, without
+    its trailing newline. Blank lines are left out.
+
+    """
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def write(self, text, kind='print'):
+        stripped = text.rstrip('\n')
+        if stripped:
+            self.messages.append(Message(kind, stripped))
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class Session:
+    """The state of one player's game.
+
+    A session has a table of commands, a current context and an output
+    stream. While a session is handling a command, the module-level
+    functions such as ``say()`` and ``set_context()`` act on it; otherwise
+    they act on the default session that ``start()`` runs.
+
+    Many sessions can share one CommandTable. Call its ``freeze()`` method
+    first so that it cannot be changed underneath them.
+
+    `output` is an Output, a file-like object, or None for ``sys.stdout``.
+    The response to each command is written to it in one go. `width` is the
+    width to wrap text to, or None to use the width of the terminal.
+
+    Only text printed with ``say()`` or the session's ``print()`` method goes
+    to `output`; the built-in ``print()`` writes straight to ``sys.stdout``.
+
+    """
+    #: Whether to write the response to a command in one go once it is
+    #: complete, rather than as it is printed
+    buffered = True
+
+    def __init__(self, commands=None, context=None, output=None, width=None):
+        if commands is None:
+            commands = globals()['commands']
+        _validate_context(context)
+        if not isinstance(output, Output):
+            output = StreamOutput(output)
+        self.commands = commands
+        self.context = context
+        self.output = output
+        self.width = width
+        self._output = None
+        self._echo = False
+        self._random = None
+        self._transcript = None
+
+        #: The seed given to ``seed()``, or None
+        self.random_seed = None
+
+    def __repr__(self):
+        return '<%s context=%r>' % (type(self).__name__, self.context)
+
+    def set_context(self, new_context):
+        """Set the context of this session."""
+        _validate_context(new_context)
+        self.context = new_context
+
+    @property
+    def random(self):
+        """The random number generator for this session.
+
+        This is the ``random`` module unless ``seed()`` has been called.
+
+        """
+        if self._random is None:
+            import random
+            self._random = random
+        return self._random
+
+    def seed(self, a):
+        """Give this session its own random number generator, seeded with a.
+        """
+        import random
+        self._random = random.Random(a)
+        self.random_seed = a
+
+    def record(self, file, seed=None):
+        """Start recording the game in this session to a transcript file.
+
+        The random number generator is seeded with `seed`, or a random seed
+        if it is None, and the seed is recorded so that ``replay()`` can
+        play the game again exactly. Each command is written to the file as
+        soon as it has been handled.
+
+        """
+        if seed is None:
+            seed = int.from_bytes(os.urandom(4), 'big')
+        self.stop_recording()
+        self.seed(seed)
+        self._transcript = _TranscriptWriter(file, seed, self.context)
+
+    def stop_recording(self):
+        """Stop recording the game and close the transcript file."""
+        if self._transcript is not None:
+            self._transcript.close()
+            self._transcript = None
+
+    def when(self, command, context=None, **kwargs):
+        """Decorator for command functions in this session's table."""
+        def dec(func):
+            _register(command, func, context, kwargs, table=self.commands)
+            return func
+        return dec
+
+    def print(self, *values, end='\n', flush=False, kind='print'):
+        """Print values to the output of this session.
+
+        While a command is being handled, output is collected for its
+        Response, and is only written out as it is printed if the session
+        is not `buffered`; `flush` has no effect.
+
+        """
+        text = ' '.join(str(v) for v in values) + end
+        if _stats is not None:
+            _stats.output_bytes += len(text.encode('utf-8'))
+        if self._output is not None:
+            self._output.append(Message(kind, text))
+            if not self._echo:
+                return
+        self.output.write(text, kind)
+        self.output.flush()
+
+    def say(self, msg):
+        """Print a message to this session, formatted as by say()."""
+        width = self.width
+        if width is None:
+            width = _terminal_width
+            if width is None:
+                width = get_terminal_size()[0]
+        self.print(_format(msg, width), kind='say')
+
+    def _resolve(self, cmd):
+        """Find the (pattern, func, args) for a command, or None."""
+        return self.commands.resolve(cmd.lower().split(), self.context)
+
+    def _call(self, cmd, resolved):
+        """Call the handler for a command, returning what it returns."""
+        if resolved is None:
+            return no_command_matches(cmd)
+        _, func, args = resolved
+        return func(**args)
+
+    def respond(self, cmd):
+        """Handle a command and return a Response, without printing it.
+
+        Coroutine handlers are run to completion in a new event loop; use
+        ``respond_async()`` to await them in a running one.
+
+        """
+        return self._respond(cmd, [])
+
+    def _respond(self, cmd, output, echo=False):
+        """Handle a command, collecting its output in the list output.
+
+        If echo is true, output is also written as it is printed.
+
+        """
+        token = _session.set(self)
+        outer = self._output, self._echo
+        self._output = output
+        self._echo = echo
+        context_before = self.context
+        try:
+            started = time.perf_counter()
+            resolved = self._resolve(cmd)
+            matched = time.perf_counter()
+            try:
+                result = self._call(cmd, resolved)
+                if isinstance(result, Awaitable):
+                    import asyncio
+                    asyncio.run(result)
+            except SystemExit as e:
+                # Let respond_stream() yield the response to quit
+                e.response = self._response(
+                    cmd, resolved, output, context_before, started, matched
+                )
+                raise
+            return self._response(
+                cmd, resolved, output, context_before, started, matched
+            )
+        finally:
+            self._output, self._echo = outer
+            _session.reset(token)
+
+    def respond_stream(self, lines):
+        """Handle each of lines in turn, yielding a Response for each.
+
+        Nothing is printed and blank lines are skipped. Responses are
+        yielded as each command is handled, so `lines` can be a file or
+        any other iterable. If a command calls ``sys.exit()``, as ``quit``
+        does, its Response is the last one yielded; Python does not exit.
+
+        """
+        respond = self._respond
+        for line in lines:
+            cmd = line.strip()
+            if not cmd:
+                continue
+            try:
+                response = respond(cmd, [])
+            except SystemExit as e:
+                yield e.response
+                return
+            yield response
+
+    async def respond_async(self, cmd):
+        """Handle a command and return a Response, without printing it.
+
+        The handler is awaited if it is a coroutine.
+
+        """
+        return await self._respond_async(cmd, [])
+
+    async def _respond_async(self, cmd, output, echo=False):
+        token = _session.set(self)
+        outer = self._output, self._echo
+        self._output = output
+        self._echo = echo
+        context_before = self.context
+        try:
+            started = time.perf_counter()
+            resolved = self._resolve(cmd)
+            matched = time.perf_counter()
+            result = self._call(cmd, resolved)
+            if isinstance(result, Awaitable):
+                await result
+            return self._response(
+                cmd, resolved, output, context_before, started, matched
+            )
+        finally:
+            self._output, self._echo = outer
+            _session.reset(token)
+
+    def _response(self, cmd, resolved, output, context_before, started,
+                  matched):
+        """Make the Response for a command that has been handled."""
+        finished = time.perf_counter()
+        pattern, func, args = resolved or (None, None, {})
+        if _stats is not None:
+            _stats.record_command(cmd, pattern, finished - matched)
+        response = Response(
+            cmd, pattern, func, args, output,
+            context_before, self.context, finished - started
+        )
+        if self._transcript is not None:
+            self._transcript.add(response)
+        return response
+
+    def _echoing(self):
+        """Whether a command handled now should write output as it goes."""
+        if self._output is not None:
+            return self._echo  # as the command that is handling this one
+        return not self.buffered
+
+    def _write(self, output, end, echoed):
+        """Write the output of a command and end, in one go.
+
+        If this command was handled by another command, its output becomes
+        part of the output of that command, so that it stays in order.
+
+        """
+        if self._output is not None:
+            self._output.extend(output)
+        elif not echoed:
+            for kind, text in output:
+                self.output.write(text, kind)
+        self.print(end=end)
+
+    def handle(self, cmd):
+        """Handle a command typed by the player of this session.
+
+        The output is written to the session's output, and the Response
+        returned.
+
+        """
+        output = []
+        echo = self._echoing()
+        try:
+            response = self._respond(cmd, output, echo)
+        except BaseException:
+            self._write(output, '', echo)
+            raise
+        self._write(output, '\n', echo)
+        return response
+
+    async def handle_async(self, cmd):
+        """Handle a command, awaiting the handler if it is a coroutine."""
+        output = []
+        echo = self._echoing()
+        try:
+            response = await self._respond_async(cmd, output, echo)
+        except BaseException:
+            self._write(output, '', echo)
+            raise
+        self._write(output, '\n', echo)
+        return response
+
+    def install_help(self):
+        """Add the ``help`` and ``?`` commands, if they are not present.
+
+        A frozen table may be shared with other sessions, so rather than
+        changing it, the session is given a frozen copy with help added.
+
+        """
+        help = globals()['help']
+        table = self.commands
+        if any(func is help for _, func, _ in table):
+            return
+        frozen = table.frozen
+        if frozen:
+            table = table.copy()
+        qmark = Pattern('help')
+        qmark.prefix = ['?']
+        qmark.orig_pattern = '?'
+        table.insert(0, (Pattern('help'), help, {}))
+        table.insert(0, (qmark, help, {}))
+        if frozen:
+            table.freeze()
+            self.commands = table
+
+    def start(self, help=True):
+        """Run the game, reading commands from the terminal."""
+        try:
+            import readline  # noqa: adds readline semantics to input()
+        except ImportError:
+            pass
+        if help:
+            self.install_help()
+        stop_tracking = _track_terminal_width()
+        try:
+            while True:
+                try:
+                    cmd = input(prompt()).strip()
+                except EOFError:
+                    self.print()
+                    break
+
+                if not cmd:
+                    continue
+
+                self.handle(cmd)
+        finally:
+            if stop_tracking is not None:
+                stop_tracking()
+
+    async def start_async(self, reader=None, help=True):
+        """Run the game, reading commands from an asyncio StreamReader.
+
+        If `reader` is None, read commands from standard input. If the
+        output has a ``drain()`` coroutine method, as _StreamWriterOutput
+        does, it is awaited after each prompt.
+
+        """
+        if help:
+            self.install_help()
+        if reader is None:
+            reader = await _stdin_reader()
+        drain = getattr(self.output, 'drain', None)
+        while True:
+            self.print(prompt(), end='', flush=True, kind='prompt')
+            if drain is not None:
+                await drain()
+            line = await reader.readline()
+            if not line:
+                self.print()
+                break
+
+            cmd = line.decode(errors='replace').strip()
+            if not cmd:
+                continue
+
+            await self.handle_async(cmd)
+
+
+async def _stdin_reader():
+    """Return an asyncio StreamReader that reads from standard input."""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    protocol = asyncio.StreamReaderProtocol(reader)
+    await loop.connect_read_pipe(lambda: protocol, sys.stdin)
+    return reader
+
+
+class _DefaultSession(Session):
+    """The session used when no other session is handling a command.
+
+    Its commands and context are kept in the module globals `commands` and
+    `current_context`, so that it follows them if they are replaced.
+
+    Its output is not buffered, so that it stays in order with text written
+    by the built-in ``print()`` and with ``input()`` prompts.
+
+    """
+    buffered = False
+
+    @property
+    def commands(self):
+        return commands
+
+    @commands.setter
+    def commands(self, value):
+        global commands
+        commands = value
+
+    @property
+    def context(self):
+        return current_context
+
+    @context.setter
+    def context(self, value):
+        global current_context
+        current_context = value
+
+
+def get_session():
+    """Get the session that is currently handling a command."""
+    return _session.get()
+
+
+class _StreamWriterOutput(Output):
+    """Send output to an asyncio StreamWriter.
+
+    Newlines are translated to CRLF, as telnet clients expect.
+
+    """
+    def __init__(self, writer, encoding='utf-8'):
+        super().__init__()
+        self.writer = writer
+        self.encoding = encoding
+
+    def send(self, text):
+        self.writer.write(text.replace('\n', '\r\n').encode(self.encoding))
+
+    async def drain(self):
+        await self.writer.drain()
+
+
+async def create_server(
+        host='localhost', port=4000, commands=None, help=True, width=80,
+        on_connect=None, sock=None):
+    """Create an asyncio server that runs a game for each connection.
+
+    Each connection gets its own Session, sharing `commands` (by default,
+    the commands defined with ``@when``), so players have their own context
+    and see only their own output. Lines of text are read from the
+    connection; ``quit`` closes the connection.
+
+    If `on_connect` is given, it is called with no arguments when a player
+    connects, while their session is current. Use it to welcome the player
+    and set up their state on ``get_session()``.
+
+    If `sock` is given, accept connections on that listening socket rather
+    than binding to `host` and `port`.
+
+    If `help` is true, the help commands are added to the server's own copy
+    of `commands`, leaving `commands` itself unchanged.
+
+    Return the asyncio Server.
+
+    """
+    import asyncio
+    if commands is None:
+        commands = globals()['commands']
+    if help:
+        commands = commands.copy()
+        Session(commands).install_help()
+
+    async def connection(reader, writer):
+        output = _StreamWriterOutput(writer)
+        session = Session(commands, output=output, width=width)
+        _session.set(session)  # this task is only ever this session
+        try:
+            if on_connect is not None:
+                on_connect()
+            await session.start_async(reader, help=False)
+        except SystemExit:
+            session.print()
+        except ConnectionError:
+            return
+        finally:
+            writer.close()
+
+    if sock is not None:
+        return await asyncio.start_server(connection, sock=sock)
+    return await asyncio.start_server(connection, host, port)
+
+
+def serve(host='localhost', port=4000, workers=1, **kwargs):
+    """Serve the game to many players over TCP, eg. with telnet.
+
+    This runs until interrupted. Other keyword arguments are passed to
+    ``create_server()``.
+
+    If `workers` is more than 1, the game is served by that many worker
+    processes forked from this one, so that all the CPUs of the machine can
+    be used. Define all rooms, items and commands before calling
+    ``serve()``: the workers share them with this process rather than
+    building them again. Each player stays connected to one worker, so
+    state shared between players in global variables is not shared between
+    workers.
+
+    """
+    if workers > 1:
+        import socket
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(128)
+        _serve_prefork(sock, workers, kwargs)
+    else:
+        _serve_worker(None, dict(kwargs, host=host, port=port))
+
+
+def _serve_worker(sock, kwargs):
+    """Run a server in this process until interrupted."""
+    import asyncio
+
+    async def run():
+        server = await create_server(sock=sock, **kwargs)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+def _serve_prefork(sock, workers, kwargs):
+    """Serve connections to the listening socket `sock` from worker processes.
+
+    A frozen copy of the command table, with the help commands installed,
+    is made before forking; the caller's table is left unchanged. The
+    workers then share all of the game's objects with this process
+    copy-on-write; we freeze the garbage collector so that collections in
+    the workers do not write to, and so copy, those pages.
+
+    All the workers accept connections from the same socket, so the
+    operating system hands each new connection to whichever worker is
+    waiting for one.
+
+    """
+    import gc
+    import signal
+
+    if not hasattr(os, 'fork'):
+        raise OSError('Serving with multiple workers requires os.fork()')
+
+    kwargs = dict(kwargs)
+    table = kwargs.get('commands')
+    if table is None:
+        table = commands
+    table = kwargs['commands'] = table.copy()
+    if kwargs.get('help', True):
+        Session(table).install_help()
+    kwargs['help'] = False
+    table.freeze()
+
+    def terminate(signum, frame):
+        sys.exit(0)
+
+    gc.collect()
+    gc.freeze()
+    pids = []
+    previous = signal.signal(signal.SIGTERM, terminate)
+    try:
+        for _ in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    signal.signal(signal.SIGTERM, previous)
+                    _serve_worker(sock, kwargs)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        sock.close()
+        for pid in pids:
+            os.waitpid(pid, 0)
+        pids = []
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        signal.signal(signal.SIGTERM, previous)
+        gc.unfreeze()
+
+
+#: The results of ``load_test()``.
+LoadTestResult = namedtuple(
+    'LoadTestResult',
+    'clients commands seconds commands_per_second p99_latency'
+)
+
+
+async def load_test(host, port, script, clients=10, repeat=1, prompt='> '):
+    """Measure the performance of a server started with ``serve()``.
+
+    Connect `clients` players at once, each of which sends the lines in
+    `script` `repeat` times, waiting for the next prompt after each one.
+    The script should not include ``quit``.
+
+    Return a LoadTestResult giving the throughput in commands per second
+    and the 99th percentile latency of a command, in seconds.
+
+    """
+    import asyncio
+    marker = prompt.encode()
+    latencies = []
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            await reader.readuntil(marker)
+            for _ in range(repeat):
+                for line in script:
+                    sent = time.perf_counter()
+                    writer.write(line.encode() + b'\n')
+                    await reader.readuntil(marker)
+                    latencies.append(time.perf_counter() - sent)
+        finally:
+            writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    n = len(latencies)
+    return LoadTestResult(
+        clients=clients,
+        commands=n,
+        seconds=elapsed,
+        commands_per_second=n / elapsed if elapsed else 0.0,
+        p99_latency=latencies[min(n - 1, n * 99 // 100)] if n else 0.0,
+    )
+
+
+#: The version of the transcript file format written by ``record()``
+TRANSCRIPT_VERSION = 1
+
+
+def _digest(text):
+    """Return a short checksum of the output of a command."""
+    import zlib
+    return '%08x' % zlib.crc32(text.encode('utf-8'))
+
+
+class _TranscriptWriter:
+    """Write a transcript of a game, line by line.
+
+    The file starts with a header line, the random seed and the initial
+    context. Each command is then written as the checksum of its output
+    followed by the command, and followed by a ``context`` line whenever
+    the context changes.
+
+    """
+    def __init__(self, file, seed, context):
+        self.owned = isinstance(file, (str, bytes, os.PathLike))
+        if self.owned:
+            file = open(file, 'w', buffering=1, encoding='utf-8')
+        self.file = file
+        self.context = context
+        file.write('adventurelib transcript %d\n' % TRANSCRIPT_VERSION)
+        file.write('seed %d\n' % seed)
+        self.write_context(context)
+
+    def write_context(self, context):
+        self.file.write('context %s\n' % ('' if context is None else context))
+        self.context = context
+
+    def add(self, response):
+        """Record a command and the checksum of its output."""
+        self.file.write('%s %s\n' % (_digest(response.text), response.command))
+        if response.context_after != self.context:
+            self.write_context(response.context_after)
+
+    def close(self):
+        if self.owned:
+            self.file.close()
+
+
+def _read_transcript(path):
+    """Read a transcript file.
+
+    Return (seed, context, steps) where steps is a list of
+    (line number, command, checksum, context after).
+
+    """
+    with open(path, encoding='utf-8') as f:
+        header = f.readline().split()
+        if header[:2] != ['adventurelib', 'transcript'] or \
+                header[2:] != [str(TRANSCRIPT_VERSION)]:
+            raise ValueError('%s is not a transcript file' % path)
+        seed = None
+        context = initial = None
+        steps = []
+        for lineno, line in enumerate(f, start=2):
+            key, _, value = line.rstrip('\n').partition(' ')
+            if key == 'seed':
+                seed = int(value)
+            elif key == 'context':
+                context = value or None
+                if steps:
+                    steps[-1][3] = context
+                else:
+                    initial = context
+            else:
+                steps.append([lineno, value, key, context])
+    return seed, initial, steps
+
+
+#: The result of replaying a transcript, as returned by ``replay()``
+ReplayResult = namedtuple(
+    'ReplayResult',
+    'transcript commands seconds commands_per_second mismatches'
+)
+
+#: A command in a replayed transcript that did not do what was recorded.
+#: `what` is ``'output'``, ``'context'``, or ``'quit'`` if the game ended
+#: before the command.
+Mismatch = namedtuple('Mismatch', 'line command what')
+
+
+def replay(path, session=None):
+    """Play the game recorded in a transcript again, without printing.
+
+    Commands are handled in `session`, by default the current session,
+    with the recorded random seed and starting context. Game state that is
+    not kept on the session, such as global variables, is not reset; see
+    ``replay_all()`` to replay transcripts in fresh processes.
+
+    Return a ReplayResult giving the throughput in commands per second and
+    a list of Mismatches for commands whose output or context differed from
+    the recording.
+
+    """
+    if session is None:
+        session = get_session()
+    seed, context, steps = _read_transcript(path)
+    if seed is not None:
+        session.seed(seed)
+    session.set_context(context)
+    mismatches = []
+    n = 0
+    started = time.perf_counter()
+    responses = session.respond_stream(step[1] for step in steps)
+    for (lineno, cmd, digest, context), response in zip(steps, responses):
+        n += 1
+        if _digest(response.text) != digest:
+            mismatches.append(Mismatch(lineno, cmd, 'output'))
+        elif response.context_after != context:
+            mismatches.append(Mismatch(lineno, cmd, 'context'))
+    elapsed = time.perf_counter() - started
+    if n < len(steps):
+        lineno, cmd, _, _ = steps[n]
+        mismatches.append(Mismatch(lineno, cmd, 'quit'))
+    return ReplayResult(
+        transcript=path,
+        commands=n,
+        seconds=elapsed,
+        commands_per_second=n / elapsed if elapsed else 0.0,
+        mismatches=mismatches,
+    )
+
+
+def _replay_worker(args):
+    """Load a game in this process and replay a transcript in it."""
+    game, path = args
+    if game.endswith('.py'):
+        import runpy
+        runpy.run_path(game, run_name='__replay__')
+    else:
+        import importlib
+        importlib.import_module(game)
+    return replay(path)
+
+
+def replay_all(game, paths, processes=None):
+    """Replay many transcripts of a game, in parallel.
+
+    `game` is the name of the game's module, or the path to its ``.py``
+    file. It must not call ``start()`` when it is imported other than as
+    ``__main__``. Each transcript is replayed in a fresh process that loads
+    the game, using up to `processes` processes at once (by default, one
+    per CPU).
+
+    Return a list of ReplayResults, in the order of `paths`.
+
+    """
+    import multiprocessing
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(processes, maxtasksperchild=1) as pool:
+        return pool.map(_replay_worker, [(game, p) for p in paths], 1)
+
+
+def _load_game(game, table, session):
+    """Load a game as a new module, defining its commands in table.
+
+    The module is not added to ``sys.modules``, so each call loads a fresh
+    copy of the game.
+
+    """
+    global commands
+    import importlib.util
+    if game.endswith('.py'):
+        name = os.path.splitext(os.path.basename(game))[0]
+        spec = importlib.util.spec_from_file_location(name, game)
+    else:
+        spec = importlib.util.find_spec(game)
+        if spec is None:
+            raise ImportError('No game module named %r' % game, name=game)
+    module = importlib.util.module_from_spec(spec)
+    saved = commands
+    commands = table
+    token = _session.set(session)
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        commands = saved
+        _session.reset(token)
+    return module
+
+
+class Playthrough:
+    """Play a game without a terminal, to test it.
+
+    `game` is the name of the game's module, or the path to its ``.py``
+    file. It is loaded as a new module with its own commands and Session,
+    so each Playthrough starts a new game. The game must only call
+    ``start()`` when it is run as ``__main__``.
+
+    Changes that the game makes to adventurelib's classes, such as setting
+    attributes on Room, are seen by every Playthrough in the same process;
+    ``run_playthroughs()`` runs each script in a process of its own.
+
+    The game's random number generator is seeded with `seed`, so that the
+    game plays the same way every time.
+
+    """
+    def __init__(self, game, width=80, seed=0, help=True):
+        self.commands = CommandTable([(Pattern('quit'), sys.exit, {})])
+        self.output = StringOutput()
+        self.session = Session(self.commands, output=self.output, width=width)
+        self.session.seed(seed)
+
+        #: The game's module, to look at the state of the game
+        self.game = _load_game(game, self.commands, self.session)
+        if help:
+            self.session.install_help()
+
+        #: The Response to the last command, how many commands have been
+        #: sent, and whether the game has quit
+        self.response = None
+        self.sent = 0
+        self.finished = False
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, self.game.__name__)
+
+    @property
+    def text(self):
+        """All of the output of the game so far."""
+        return self.output.getvalue()
+
+    def send(self, cmd):
+        """Handle a command, and return its Response."""
+        if self.finished:
+            raise RuntimeError('The game has finished')
+        self.sent += 1
+        try:
+            self.response = self.session.handle(cmd)
+        except SystemExit as e:
+            self.response = e.response
+            self.finished = True
+        return self.response
+
+    def play(self, lines):
+        """Handle each of lines in turn. Return the list of Responses."""
+        return [self.send(line) for line in lines if line.strip()]
+
+    #######
+    # Assertions about the state of the game
+    #######
+    def _resolve(self, obj):
+        """Look up obj in the game's globals, if it is a name."""
+        if isinstance(obj, str):
+            return getattr(self.game, obj)
+        return obj
+
+    def expect(self, text):
+        """Assert that the last command printed text."""
+        output = self.response.text if self.response else self.text
+        if text not in output:
+            raise AssertionError('%r not printed; output was:\n%s' % (
+                text, output
+            ))
+
+    def expect_context(self, context):
+        """Assert that the game is in the given context."""
+        actual = self.session.context
+        if actual != context:
+            raise AssertionError(
+                'Context is %r, not %r' % (actual, context)
+            )
+
+    def expect_room(self, room, current='current_room'):
+        """Assert that the player is in room.
+
+        `room` is a Room or the name of one in the game's globals. `current`
+        is the name of the global that holds the player's room.
+
+        """
+        room = self._resolve(room)
+        actual = getattr(self.game, current)
+        if actual is not room:
+            raise AssertionError('In %r, not %r' % (str(actual), str(room)))
+
+    def expect_item(self, bag, name, present=True):
+        """Assert that an Item called name is in bag, or not if present is
+        false.
+
+        `bag` is a Bag or the name of one in the game's globals.
+
+        """
+        bag = self._resolve(bag)
+        if (name in bag) != present:
+            raise AssertionError('%r is %sin %r' % (
+                name, 'not ' if present else '', sorted(map(str, bag))
+            ))
+
+
+#: The result of a playthrough script run by ``run_playthroughs()``.
+#: `error` is None if the script passed, or else the traceback.
+PlaythroughResult = namedtuple(
+    'PlaythroughResult',
+    'script error commands seconds'
+)
+
+
+def _playthrough_worker(args):
+    """Run one playthrough script of a game."""
+    game, script = args
+    name = getattr(script, '__qualname__', repr(script))
+    started = time.perf_counter()
+    playthrough = None
+    try:
+        playthrough = Playthrough(game)
+        script(playthrough)
+    except Exception:
+        import traceback
+        error = traceback.format_exc()
+    else:
+        error = None
+    n = playthrough.sent if playthrough is not None else 0
+    return PlaythroughResult(name, error, n, time.perf_counter() - started)
+
+
+def run_playthroughs(game, scripts, processes=None):
+    """Run playthrough scripts for a game, in parallel.
+
+    Each script is a function that is called with a new Playthrough of
+    `game` and drives it with ``send()`` and the ``expect`` methods. Each
+    script is run in a fresh process, using up to `processes` processes at
+    once (by default, one per CPU), so scripts must be defined at the top
+    level of a module.
+
+    Return a list of PlaythroughResults, in the order of `scripts`.
+
+    """
+    import multiprocessing
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(processes, maxtasksperchild=1) as pool:
+        return pool.map(_playthrough_worker, [(game, s) for s in scripts], 1)
+
+
+commands = CommandTable([
+    (Pattern('quit'), sys.exit, {}),  # quit command is built-in
+])
+
+_default_session = _DefaultSession(commands)
+
+#: The session that is currently handling a command.
+_session = ContextVar('adventurelib_session', default=_default_session)
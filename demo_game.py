@@ -37,7 +37,7 @@ def go(direction):
             set_context('default')
 
 
-@when('take ITEM')
+@when('take|get ITEM')
 def take(item):
     obj = current_room.items.take(item)
     if obj:
@@ -57,7 +57,7 @@ def drop(thing):
         current_room.items.add(obj)
 
 
-@when('look')
+@when('look [around]')
 def look():
     say(current_room)
     if current_room.items:
@@ -80,4 +80,5 @@ def cast(magic):
         say("A flaming Fireball shoots form your hands!")
 
 look()
-start()
+if __name__ == '__main__':
+    start()
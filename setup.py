@@ -22,12 +22,7 @@ setup(
         'Documentation': 'https://adventurelib.readthedocs.io/'
     },
     py_modules=['adventurelib'],
-    extras_require={
-        ':python_version < "3.3"': [
-            'backports.shutil_get_terminal_size>=1.0.0',
-        ],
-    },
-    python_requires='>=3',
+    python_requires='>=3.7',
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: Education',
@@ -1,4 +1,14 @@
-from unittest.mock import patch
+import asyncio
+import gc
+import os
+import random
+import runpy
+import signal
+import socket
+import subprocess
+import sys
+import weakref
+from unittest.mock import Mock, patch
 from contextlib import redirect_stdout, contextmanager
 from io import StringIO
 
@@ -6,6 +16,7 @@ import pytest
 
 import adventurelib
 from adventurelib import Pattern, when, _handle_command, say, Room, Item, Bag
+from adventurelib import Placeholder, set_context
 
 orig_commands = adventurelib.commands[:]
 
@@ -21,7 +32,7 @@ def active_context(ctx):
         adventurelib.set_context(prev_ctx)
 
 
-def teardown():
+def teardown_function():
     """Reset the commands."""
     adventurelib.commands[:] = orig_commands
 
@@ -79,6 +90,33 @@ def test_multiple_multiword_captures():
     assert matches == {'item': 'golden apple', 'person': 'evil wizard'}
 
 
+def test_alternatives():
+    """Words in a pattern can have alternatives."""
+    pat = Pattern('take|get|grab ITEM from|off THING')
+    assert pat.match(['get', 'apple', 'off', 'tree']) == {
+        'item': 'apple', 'thing': 'tree'
+    }
+    assert pat.match(['grab', 'apple', 'from', 'tree']) == {
+        'item': 'apple', 'thing': 'tree'
+    }
+    assert pat.match(['steal', 'apple', 'from', 'tree']) is None
+
+
+def test_optional_words():
+    """Words in brackets are optional, and matched if present."""
+    pat = Pattern('look [at|in] THING')
+    assert pat.match(['look', 'at', 'cat']) == {'thing': 'cat'}
+    assert pat.match(['look', 'in', 'box']) == {'thing': 'box'}
+    assert pat.match(['look', 'cat']) == {'thing': 'cat'}
+    assert pat.match(['look']) is None
+
+
+def test_optional_placeholder():
+    """Placeholders cannot be optional."""
+    with pytest.raises(adventurelib.InvalidCommand):
+        Pattern('look [THING]')
+
+
 def test_word_combinations():
     combos = Pattern.word_combinations(have=3, placeholders=2)
     assert list(combos) == [
@@ -117,6 +155,62 @@ def test_word_combinations_4():
     ]
 
 
+def combinations_match(pattern, input_words):
+    """Match input words by trying every bucket assignment in turn.
+
+    This is the original implementation of Pattern.match(), kept as a
+    reference for the compiled matcher.
+
+    """
+    if len(input_words) < len(pattern.argnames):
+        return None
+    if input_words[:len(pattern.prefix)] != pattern.prefix:
+        return None
+    input_words = input_words[len(pattern.prefix):]
+    if not input_words and not pattern.pattern:
+        return {}
+    if bool(input_words) != bool(pattern.pattern):
+        return None
+
+    have = len(input_words) - pattern.fixed
+    for combo in Pattern.word_combinations(have, pattern.placeholders):
+        matches = {}
+        take = iter(combo)
+        inp = iter(input_words)
+        try:
+            for cword in pattern.pattern:
+                if isinstance(cword, Placeholder):
+                    matches[cword.name] = [
+                        next(inp) for _ in range(next(take))
+                    ]
+                elif cword != next(inp):
+                    break
+            else:
+                return {k: ' '.join(v) for k, v in matches.items()}
+        except StopIteration:
+            continue
+    return None
+
+
+def test_match_same_as_combinations():
+    """The compiled matcher agrees with enumerating word combinations."""
+    rng = random.Random(1234)
+    vocab = ['to', 'with', 'at', 'red']
+    for _ in range(3000):
+        words = []
+        names = iter('ABCDE')
+        for _ in range(rng.randint(1, 6)):
+            if rng.random() < 0.4:
+                words.append(next(names, 'to'))
+            else:
+                words.append(rng.choice(vocab))
+        pattern = Pattern(' '.join(words))
+        inp = [rng.choice(vocab) for _ in range(rng.randint(0, 9))]
+        assert pattern.match(inp) == combinations_match(pattern, inp), (
+            pattern, inp
+        )
+
+
 def test_register():
     called = False
 
@@ -141,6 +235,20 @@ def test_register_args():
     assert args == ['north']
 
 
+def test_register_alternatives():
+    """A pattern with alternatives and optional words is one command."""
+    args = []
+
+    @when('[please] take|get ITEM', verb='take')
+    def take(item, verb):
+        args.append((verb, item))
+
+    assert len(adventurelib.commands) == len(orig_commands) + 1
+    _handle_command('get lamp')
+    _handle_command('please take lamp')
+    assert args == [('take', 'lamp'), ('take', 'lamp')]
+
+
 @pytest.mark.parametrize('ctx,expected', [
     (None, 'north'),
     ('confused', 'south'),
@@ -173,6 +281,809 @@ def test_register_match():
     assert args == ['dragon', 'glass sword', 'hit']
 
 
+def test_dispatch_candidates():
+    """Only commands whose literal prefix matches are candidates."""
+    @when('take THING')
+    @when('look at THING')
+    @when('THING')
+    def func(thing):
+        pass
+
+    @when('look')
+    def look():
+        pass
+
+    def patterns(words):
+        cmds = adventurelib.commands
+        return [cmds[i][0].orig_pattern for i in cmds.candidates(words)]
+
+    assert patterns(['look', 'at', 'cat']) == [
+        'THING', 'look', 'look at THING'
+    ]
+    assert patterns(['take', 'cat']) == ['THING', 'take THING']
+    assert patterns(['jump']) == ['THING']
+
+
+def test_dispatch_index_rebuilt():
+    """The dispatch index follows changes to the commands list."""
+    called = []
+
+    @when('jump')
+    def jump():
+        called.append('jump')
+
+    _handle_command('jump')
+    adventurelib.commands[:] = orig_commands
+    _handle_command('jump')
+    assert called == ['jump']
+
+
+def test_active_commands_cached():
+    """The ordered list of active commands is cached per context."""
+    cmds = adventurelib.commands
+    with active_context('confused'):
+        first = adventurelib._available_commands()
+        assert cmds.active('confused') is cmds.active('confused')
+
+        @when('north', context='confused')
+        def north():
+            pass
+
+        second = adventurelib._available_commands()
+    assert second == [cmds[-1]] + first
+
+
+def test_parse_cache():
+    """Repeated commands are resolved from the parse cache."""
+    taken = []
+
+    @when('take ITEM')
+    def take(item):
+        taken.append(item)
+
+    adventurelib.set_parse_cache_size(10)
+    try:
+        _handle_command('take key')
+        _handle_command('TAKE   key')
+        info = adventurelib.parse_cache_info()
+        assert (info.hits, info.misses, info.currsize) == (1, 1, 1)
+    finally:
+        adventurelib.set_parse_cache_size(0)
+    assert taken == ['key', 'key']
+
+
+def test_parse_cache_args_are_copied():
+    """Changing the args of a response does not change the parse cache."""
+    taken = []
+
+    @when('take ITEM')
+    def take(item):
+        taken.append(item)
+
+    adventurelib.set_parse_cache_size(10)
+    try:
+        with redirect_stdout(StringIO()):
+            for _ in range(2):
+                adventurelib.respond('take key').args['item'] = 'sword'
+            _handle_command('take key')
+    finally:
+        adventurelib.set_parse_cache_size(0)
+    assert taken == ['key', 'key', 'key']
+
+
+def test_parse_cache_invalidated():
+    """Registering a command clears the parse cache."""
+    called = []
+
+    adventurelib.set_parse_cache_size(10)
+    try:
+        _handle_command('jump')
+
+        @when('jump')
+        def jump():
+            called.append('jump')
+
+        _handle_command('jump')
+    finally:
+        adventurelib.set_parse_cache_size(0)
+    assert called == ['jump']
+
+
+def test_sessions_share_commands():
+    """Sessions sharing a command table have their own context and output."""
+    @when('north', context='confused')
+    def north():
+        say('You go %s.' % adventurelib.get_context())
+        set_context('confused.really')
+
+    table = adventurelib.CommandTable(adventurelib.commands)
+    table.freeze()
+    outputs = [StringIO(), StringIO()]
+    sessions = [
+        adventurelib.Session(table, context='confused', output=out)
+        for out in outputs
+    ]
+    sessions[0].handle('north')
+    assert sessions[0].context == 'confused.really'
+    assert sessions[1].context == 'confused'
+    assert adventurelib.get_context() is None
+    assert outputs[0].getvalue() == 'You go confused.\n\n'
+    assert outputs[1].getvalue() == ''
+
+
+def test_output_one_write_per_command():
+    """The response to a command is written to the output in one go."""
+    @when('look')
+    def look():
+        say('You are in a cave.')
+        say('It is dark.')
+
+    out = Mock()
+    session = adventurelib.Session(output=out)
+    session.handle('look')
+    out.write.assert_called_once_with('You are in a cave.\nIt is dark.\n\n')
+
+
+def test_default_session_output_order():
+    """The default session keeps say() in order with the built-in print()."""
+    @when('riddle')
+    def riddle():
+        say('first')
+        print('second')
+        say('third')
+
+    with redirect_stdout(StringIO()) as out:
+        _handle_command('riddle')
+    assert out.getvalue() == 'first\nsecond\nthird\n\n'
+
+
+def test_default_session_follows_commands():
+    """The default session dispatches from the current global commands."""
+    saved = adventurelib.commands
+    adventurelib.commands = adventurelib.CommandTable()
+    try:
+        @when('jump')
+        def jump():
+            say('You jump.')
+
+        with redirect_stdout(StringIO()) as out:
+            _handle_command('jump')
+    finally:
+        adventurelib.commands = saved
+    assert out.getvalue() == 'You jump.\n\n'
+
+
+def test_nested_command_output_order():
+    """A command handled by another command keeps its output in order."""
+    @when('enter')
+    def enter():
+        say('You enter.')
+        _handle_command('look')
+
+    @when('look')
+    def look():
+        say('It is dark.')
+
+    out = adventurelib.StringOutput()
+    session = adventurelib.Session(output=out, width=80)
+    response = session.handle('enter')
+    assert out.sent == ['You enter.\nIt is dark.\n\n\n']
+    assert response.text == 'You enter.\nIt is dark.\n\n'
+
+
+def test_string_output():
+    """StringOutput keeps what was sent in memory."""
+    out = adventurelib.StringOutput()
+    session = adventurelib.Session(output=out)
+    session.handle('what')
+    session.handle('what')
+    assert out.sent == ["I don't understand 'what'.\n\n"] * 2
+
+
+def test_socket_output():
+    """SocketOutput sends the response with CRLF line endings."""
+    a, b = socket.socketpair()
+    with a, b:
+        session = adventurelib.Session(output=adventurelib.SocketOutput(a))
+        session.handle('what')
+        assert b.recv(1024) == b"I don't understand 'what'.\r\n\r\n"
+
+
+def test_message_output():
+    """MessageOutput records what kind of output each message was."""
+    @when('look')
+    def look():
+        say('You are in a cave.')
+
+    out = adventurelib.MessageOutput()
+    session = adventurelib.Session(output=out, width=80)
+    session.install_help()
+    session.handle('look')
+    session.handle('what')
+    session.handle('help')
+    Message = adventurelib.Message
+    assert out.messages[:3] == [
+        Message('say', 'You are in a cave.'),
+        Message('no_match', "I don't understand 'what'."),
+        Message('help', 'Here is a list of the commands you can give:'),
+    ]
+
+
+def test_respond():
+    """respond() returns what a command did, without printing it."""
+    @when('enter ROOM')
+    def enter(room):
+        say('You enter the %s.' % room)
+        set_context('inside')
+
+    out = StringIO()
+    session = adventurelib.Session(output=out, width=80)
+    response = session.respond('enter great hall')
+    assert out.getvalue() == ''
+    assert response.command == 'enter great hall'
+    assert response.pattern.orig_pattern == 'enter ROOM'
+    assert response.func is enter
+    assert response.args == {'room': 'great hall'}
+    assert response.output == [
+        adventurelib.Message('say', 'You enter the great hall.\n')
+    ]
+    assert response.text == 'You enter the great hall.\n'
+    assert response.context_before is None
+    assert response.context_after == 'inside'
+    assert response.elapsed >= 0
+
+
+def test_respond_no_match():
+    """The Response to a command that is not understood has no pattern."""
+    with redirect_stdout(StringIO()) as out:
+        response = adventurelib.respond('xyzzy')
+    assert out.getvalue() == ''
+    assert response.pattern is None
+    assert response.func is None
+    assert response.text == "I don't understand 'xyzzy'.\n"
+
+
+def test_respond_stream():
+    """respond_stream() yields Responses lazily and stops at quit."""
+    @when('jump')
+    def jump():
+        say('You jump.')
+
+    def lines():
+        yield 'jump'
+        yield ''
+        yield 'what'
+        yield 'quit'
+        raise AssertionError('read past quit')
+
+    session = adventurelib.Session(output=StringIO(), width=80)
+    responses = session.respond_stream(lines())
+    assert next(responses).text == 'You jump.\n'
+    assert next(responses).pattern is None
+    assert next(responses).func is sys.exit
+    assert list(responses) == []
+
+
+TRANSCRIPT_GAME = """
+from adventurelib import when, say, set_context, Bag, Item
+
+fruit = Bag([Item('apple'), Item('pear'), Item('plum'), Item('fig')])
+
+
+@when('pick')
+def pick():
+    say('You pick a %s.' % fruit.get_random())
+
+
+@when('enter')
+def enter():
+    set_context('orchard')
+"""
+
+
+def record_game(path, game):
+    """Run the game and record a transcript of it."""
+    runpy.run_path(game)
+    session = adventurelib.Session(output=StringIO(), width=80)
+    session.record(path)
+    for cmd in ['pick', 'enter'] + ['pick'] * 8 + ['quit']:
+        try:
+            session.handle(cmd)
+        except SystemExit:
+            pass
+    session.stop_recording()
+
+
+def test_record_replay(tmpdir):
+    """A recorded game can be replayed exactly."""
+    game = tmpdir.join('game.py')
+    game.write(TRANSCRIPT_GAME)
+    path = str(tmpdir.join('game.transcript'))
+    record_game(path, str(game))
+
+    result = adventurelib.replay(path, adventurelib.Session())
+    assert result.mismatches == []
+    assert result.commands == 11
+
+    # A different seed picks different fruit
+    with open(path) as f:
+        lines = f.readlines()
+    lines[1] = 'seed %d\n' % (int(lines[1].split()[1]) + 1)
+    with open(path, 'w') as f:
+        f.writelines(lines)
+    result = adventurelib.replay(path, adventurelib.Session())
+    assert {m.what for m in result.mismatches} == {'output'}
+
+
+def test_replay_all(tmpdir):
+    """Transcripts can be replayed in parallel in fresh processes."""
+    game = tmpdir.join('game.py')
+    game.write(TRANSCRIPT_GAME)
+    paths = [str(tmpdir.join('%d.transcript' % i)) for i in range(3)]
+    for path in paths:
+        record_game(path, str(game))
+        adventurelib.commands[:] = orig_commands
+
+    results = adventurelib.replay_all(str(game), paths, processes=2)
+    assert [r.transcript for r in results] == paths
+    assert [(r.commands, r.mismatches) for r in results] == [(11, [])] * 3
+
+
+DEMO_GAME = os.path.join(os.path.dirname(__file__), 'demo_game.py')
+
+
+def test_playthrough():
+    """A Playthrough drives a whole game and checks its state."""
+    game = adventurelib.Playthrough(DEMO_GAME)
+    assert 'You are in a dark room.' in game.text
+    game.send('north')
+    game.expect('You go north.')
+    game.expect_room('valley')
+    game.send('take mallet')
+    game.expect_item('inventory', 'mallet')
+    game.expect_item(game.game.valley.items, 'mallet', present=False)
+    game.send('north')
+    game.expect_context('magic_aura')
+    game.send('cast fireball')
+    game.expect('Fireball')
+    with pytest.raises(AssertionError):
+        game.expect_room('starting_room')
+    game.send('quit')
+    assert game.finished
+    assert adventurelib.commands[:] == orig_commands
+
+
+def test_playthroughs_isolated():
+    """Each Playthrough is a new game."""
+    first = adventurelib.Playthrough(DEMO_GAME)
+    first.play(['north', 'take mallet'])
+    second = adventurelib.Playthrough(DEMO_GAME)
+    second.expect_item('inventory', 'mallet', present=False)
+    first.expect_item('inventory', 'mallet')
+
+
+def walk_to_forest(game):
+    """A playthrough script, run by test_run_playthroughs()."""
+    game.play(['north', 'north'])
+    game.expect_room('magic_forest')
+
+
+def get_lost(game):
+    """A playthrough script that fails."""
+    game.send('south')
+    game.expect_room('valley')
+
+
+LADDER_GAME = """
+from adventurelib import when, say, Room
+
+Room.add_direction('climb', 'slide')
+
+current_room = Room('At the foot of a ladder.')
+current_room.climb = loft = Room('In the loft.')
+
+
+@when('climb')
+def climb():
+    global current_room
+    current_room = current_room.climb
+    say(current_room)
+"""
+
+
+def climb_ladder(game):
+    """A playthrough script for a game that adds a direction."""
+    game.send('climb')
+    game.expect_room('loft')
+
+
+def test_playthrough_adds_direction(tmpdir):
+    """A game that adds a direction can be loaded more than once."""
+    path = tmpdir.join('ladder.py')
+    path.write(LADDER_GAME)
+    for _ in range(2):
+        climb_ladder(adventurelib.Playthrough(str(path)))
+    results = adventurelib.run_playthroughs(
+        str(path), [climb_ladder] * 2, processes=1
+    )
+    assert [r.error for r in results] == [None, None]
+    with pytest.raises(KeyError):
+        Room.add_direction('climb', 'fall')
+
+
+def test_run_playthroughs():
+    """Playthrough scripts can be run in worker processes."""
+    results = adventurelib.run_playthroughs(
+        DEMO_GAME, [walk_to_forest, get_lost], processes=2
+    )
+    assert [(r.script, r.commands) for r in results] == [
+        ('walk_to_forest', 2), ('get_lost', 1)
+    ]
+    assert results[0].error is None
+    assert 'AssertionError' in results[1].error
+
+
+def test_frozen_commands():
+    """A frozen command table cannot be changed."""
+    table = adventurelib.CommandTable()
+    table.freeze()
+    session = adventurelib.Session(table)
+    with pytest.raises(TypeError):
+        @session.when('north')
+        def north():
+            pass
+
+
+def test_async_handler():
+    """Coroutine handlers are awaited by handle_async()."""
+    done = []
+
+    @when('wait')
+    async def wait():
+        await asyncio.sleep(0)
+        done.append('wait')
+
+    session = adventurelib.Session(output=StringIO())
+    asyncio.run(session.handle_async('wait'))
+    session.handle('wait')
+    assert done == ['wait', 'wait']
+
+
+def test_async_handler_signature():
+    """Coroutine handlers have their signatures checked."""
+    with pytest.raises(adventurelib.InvalidCommand):
+        @when('take ITEM')
+        async def take():
+            pass
+
+
+def test_start_async():
+    """start_async() reads commands from a stream reader."""
+    @when('greet PERSON')
+    async def greet(person):
+        say('Hello, %s.' % person)
+
+    async def play():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b'greet the wizard\n\nwhat\n')
+        reader.feed_eof()
+        await session.start_async(reader, help=False)
+
+    out = StringIO()
+    session = adventurelib.Session(output=out)
+    asyncio.run(play())
+    assert out.getvalue() == (
+        "> Hello, the wizard.\n\n"
+        "> > I don't understand 'what'.\n\n"
+        "> \n"
+    )
+
+
+def test_server_sessions():
+    """Each connection to the server has its own context and output."""
+    table = adventurelib.CommandTable(adventurelib.commands)
+
+    def enter():
+        say('You enter %s.' % adventurelib.get_context())
+        set_context('inside')
+
+    table.append((Pattern('enter'), enter, {}))
+
+    async def play():
+        server = await adventurelib.create_server(
+            'localhost', 0, commands=table, help=False
+        )
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            r1, w1 = await asyncio.open_connection('localhost', port)
+            r2, w2 = await asyncio.open_connection('localhost', port)
+            w1.write(b'enter\nenter\nquit\n')
+            w2.write(b'enter\nquit\n')
+            return await r1.read(), await r2.read()
+
+    out1, out2 = asyncio.run(play())
+    assert out1 == (
+        b'> You enter None.\r\n\r\n'
+        b'> You enter inside.\r\n\r\n'
+        b'> \r\n'
+    )
+    assert out2 == b'> You enter None.\r\n\r\n> \r\n'
+
+
+def test_server_frozen_commands():
+    """The server adds help to its own copy of a frozen table."""
+    table = adventurelib.CommandTable([
+        (Pattern('look'), lambda: say('A room.'), {}),
+    ])
+    table.freeze()
+
+    async def play():
+        server = await adventurelib.create_server(
+            'localhost', 0, commands=table
+        )
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection('localhost', port)
+            writer.write(b'?\nquit\n')
+            return await reader.read()
+
+    out = asyncio.run(play())
+    assert b'look' in out and b'help' in out
+    assert len(table) == 1 and table.frozen
+
+
+def test_install_help_frozen():
+    """A session with a frozen table is given a frozen copy with help."""
+    table = adventurelib.CommandTable()
+    table.freeze()
+    session = adventurelib.Session(table)
+    session.install_help()
+    assert len(table) == 0
+    assert len(session.commands) == 2 and session.commands.frozen
+
+
+def test_load_test():
+    """We can measure the throughput of the server."""
+    table = adventurelib.CommandTable(adventurelib.commands)
+    table.append((Pattern('look'), lambda: say('A room.'), {}))
+
+    async def run():
+        server = await adventurelib.create_server(
+            'localhost', 0, commands=table
+        )
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            return await adventurelib.load_test(
+                'localhost', port, ['look', 'help'], clients=5, repeat=3
+            )
+
+    result = asyncio.run(run())
+    assert result.commands == 30
+    assert result.commands_per_second > 0
+    assert 0 < result.p99_latency <= result.seconds
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires os.fork()')
+def test_prefork_server():
+    """Connections are served by worker processes forked from the server."""
+    table = adventurelib.CommandTable(adventurelib.commands)
+    table.append((Pattern('pid'), lambda: say(os.getpid()), {}))
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('localhost', 0))
+    sock.listen(16)
+    port = sock.getsockname()[1]
+
+    server_pid = os.fork()
+    if server_pid == 0:
+        try:
+            adventurelib._serve_prefork(sock, 2, {'commands': table})
+        finally:
+            os._exit(0)
+    sock.close()
+
+    async def client():
+        reader, writer = await asyncio.open_connection('localhost', port)
+        writer.write(b'pid\nquit\n')
+        return await reader.read()
+
+    async def play():
+        return await asyncio.gather(*(client() for _ in range(8)))
+
+    try:
+        outputs = asyncio.run(play())
+    finally:
+        os.kill(server_pid, signal.SIGTERM)
+        os.waitpid(server_pid, 0)
+
+    for out in outputs:
+        pid = int(out.split(b'\r\n')[0].lstrip(b'> '))
+        assert pid not in (os.getpid(), server_pid)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires os.fork()')
+def test_prefork_server_restores_sigterm():
+    """The server's SIGTERM handler is removed when it stops."""
+    table = adventurelib.CommandTable(adventurelib.commands)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    handler = Mock()
+    previous = signal.signal(signal.SIGTERM, handler)
+    try:
+        adventurelib._serve_prefork(sock, 0, {'commands': table})
+        assert signal.getsignal(signal.SIGTERM) is handler
+        assert not table.frozen
+        assert len(table) == len(adventurelib.commands)
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+
+def test_stats():
+    """We can collect statistics on command handling."""
+    @when('take ITEM')
+    def take(item):
+        say('Taken.')
+
+    hooked = []
+    stats = adventurelib.enable_stats(
+        hook=lambda cmd, pattern, seconds: hooked.append(cmd)
+    )
+    try:
+        with redirect_stdout(StringIO()):
+            _handle_command('take key')
+            _handle_command('take')
+            _handle_command('jump')
+    finally:
+        adventurelib.disable_stats()
+
+    pattern = adventurelib.commands[-1][0]
+    assert stats.commands == 3
+    assert stats.unmatched == 2
+    assert stats.hits == {pattern: 1}
+    assert stats.attempts[pattern] == 2
+    assert stats.attempts_per_command == {1: 2, 0: 1}
+    assert stats.output_bytes == len(
+        "Taken.\n\n"
+        "I don't understand 'take'.\n\n"
+        "I don't understand 'jump'.\n\n"
+    )
+    assert hooked == ['take key', 'take', 'jump']
+
+    out = StringIO()
+    stats.dump(out)
+    assert 'Commands handled: 3 (2 not understood)' in out.getvalue()
+    stats.reset()
+    assert stats.commands == 0
+    assert adventurelib.get_stats() is None
+
+
+def test_may_overlap():
+    """We can tell when two patterns could match the same input."""
+    def overlap(a, b):
+        return Pattern(a).may_overlap(Pattern(b))
+
+    assert overlap('take ITEM', 'take red ITEM')
+    assert overlap('THING', 'look')
+    assert overlap('look', 'look')
+    assert not overlap('take ITEM', 'drop ITEM')
+    assert not overlap('look', 'look at THING')
+    assert not overlap('look', 'look THING')
+
+
+def test_adaptive_ordering():
+    """Frequently matched commands are tried first when that is safe."""
+    @when('look')
+    def look():
+        pass
+
+    @when('look at THING')
+    def look_at(thing):
+        pass
+
+    @when('stroke cat')
+    def stroke():
+        pass
+
+    adventurelib.set_adaptive_ordering(5)
+    try:
+        stats = adventurelib.enable_stats()
+        for _ in range(10):
+            _handle_command('look at cat')
+    finally:
+        adventurelib.disable_stats()
+        adventurelib.set_adaptive_ordering(0)
+
+    assert stats.attempts_per_command == {2: 5, 1: 5}
+    assert stats.hits == {adventurelib.commands[-2][0]: 10}
+
+
+def test_unknown_words():
+    """Inputs with unknown words are not tried against fixed patterns."""
+    @when('look')
+    def look():
+        pass
+
+    @when('look at THING')
+    def look_at(thing):
+        pass
+
+    words, unknown = adventurelib.commands.tokenize(['look', 'at', 'x'])
+    assert words[0] is adventurelib.commands[-2][0].prefix[0]
+    assert unknown
+
+    stats = adventurelib.enable_stats()
+    try:
+        _handle_command('look at x')
+        _handle_command('look at at')
+    finally:
+        adventurelib.disable_stats()
+    assert stats.attempts_per_command == {1: 1, 2: 1}
+
+
+def test_command_cache(tmpdir):
+    """Compiled commands can be saved and loaded again."""
+    path = str(tmpdir.join('commands.cache'))
+
+    def define(func):
+        adventurelib.load_command_cache(path)
+        try:
+            when('take|get ITEM', verb='take')(func)
+            adventurelib.save_command_cache(path)
+        finally:
+            adventurelib._command_cache = None
+
+    def take(item, verb):
+        pass
+
+    define(take)
+    with patch('inspect.signature') as signature:
+        define(take)
+    assert not signature.called
+    pattern = adventurelib.commands[-1][0]
+    assert pattern.match(['get', 'lamp']) == {'item': 'lamp'}
+
+    def take(thing, verb):
+        pass
+
+    with pytest.raises(adventurelib.InvalidCommand):
+        define(take)
+
+
+#: The most time that `import adventurelib` may take, in microseconds
+IMPORT_TIME_BUDGET = 30000
+
+
+def test_import_time(tmpdir):
+    """Importing adventurelib is fast, and defers optional imports."""
+    env = dict(os.environ, PYTHONPYCACHEPREFIX=str(tmpdir))
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    code = (
+        'import sys; before = set(sys.modules); import adventurelib; '
+        'print(" ".join(set(sys.modules) - before))'
+    )
+    cwd = os.path.dirname(os.path.abspath(adventurelib.__file__))
+    # The first run writes bytecode, so we don't measure compilation
+    imported = subprocess.check_output(
+        [sys.executable, '-c', code], env=env, cwd=cwd
+    ).decode().split()
+    deferred = {
+        'readline', 'textwrap', 'inspect', 'random', 'copy', 'pickle',
+        'shutil', 'asyncio', 're',
+    }
+    assert deferred.isdisjoint(imported)
+
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import adventurelib'],
+        env=env, cwd=cwd, stderr=subprocess.PIPE, check=True
+    )
+    for line in proc.stderr.decode().splitlines():
+        _, cumulative, name = line.split('|')
+        if name.strip() == 'adventurelib':
+            assert int(cumulative) < IMPORT_TIME_BUDGET
+            break
+    else:
+        pytest.fail('adventurelib not found in importtime output')
+
+
 def say_at_width(width, msg):
     buf = StringIO()
     with patch('adventurelib.get_terminal_size', return_value=(width, 24)):
@@ -248,6 +1159,275 @@ def test_say_multiline_paragraph():
     )
 
 
+def test_say_cache():
+    """Formatted messages are remembered."""
+    adventurelib._say_cache.clear()
+    before = adventurelib.say_cache_info()
+    say_at_width(40, 'You are in a maze of twisty passages.')
+    say_at_width(40, 'You are in a maze of twisty passages.')
+    out = say_at_width(20, 'You are in a maze of twisty passages.')
+    after = adventurelib.say_cache_info()
+    assert after.hits - before.hits == 1
+    assert after.misses - before.misses == 2
+    assert out == 'You are in a maze of\ntwisty passages.\n'
+
+
+@pytest.mark.skipif(
+    not hasattr(signal, 'SIGWINCH'), reason='requires SIGWINCH'
+)
+def test_terminal_width_tracking():
+    """While the game runs, the terminal width is updated on SIGWINCH."""
+    with patch('adventurelib.get_terminal_size', return_value=(40, 24)):
+        stop = adventurelib._track_terminal_width()
+    try:
+        assert adventurelib._terminal_width == 40
+        with patch('adventurelib.get_terminal_size', return_value=(60, 24)):
+            os.kill(os.getpid(), signal.SIGWINCH)
+        assert adventurelib._terminal_width == 60
+    finally:
+        stop()
+    assert adventurelib._terminal_width is None
+
+
+def test_room_class_bags():
+    """Each room gets its own copy of Bags set on its class."""
+    class Cave(Room):
+        items = Bag([Item('rock')])
+
+    first, second = Cave('A cave.'), Cave('Another cave.')
+    rock = first.items.take('rock')
+    first.items.add(Item('torch'))
+    assert rock is not None
+    assert 'torch' in first.items
+    assert 'rock' in second.items and 'torch' not in second.items
+    assert second.items.find('rock') is not rock
+    assert isinstance(Cave.items, Bag) and 'rock' in Cave.items
+
+
+def test_room_class_bags_changed():
+    """Changing a class Bag does not change rooms that already exist."""
+    class Cave(Room):
+        items = Bag()
+
+    old = Cave('An old cave.')
+    Cave.items.add(Item('gem'))
+    assert 'gem' not in old.items
+    assert 'gem' in Cave('A new cave.').items
+
+    Cave.items = Bag()
+    older = Cave('An older cave.')
+    old.items.add(Item('bone'))
+    assert 'bone' not in Cave.items
+    assert 'gem' not in older.items and 'bone' not in older.items
+    assert 'bone' not in Cave('The newest cave.').items
+
+
+def test_room_exits():
+    """Room exits are kept by direction ID, with a bitmask of those set."""
+    hall = Room('A hall.')
+    kitchen = Room('A kitchen.')
+    assert hall.exits() == []
+    hall.west = kitchen
+    hall.north = Room('A study.')
+    assert hall.exits() == ['north', 'west']
+    assert hall.exit('west') is kitchen is hall.west
+    assert kitchen.exit('east') is hall
+    assert kitchen.exit('north') is None
+    hall.west = None
+    assert hall.exits() == ['north']
+    assert Room.north is None
+    with pytest.raises(KeyError):
+        hall.exit('up')
+
+
+def test_path_to():
+    """Room.path_to() finds the shortest route, and notices new exits."""
+    rooms = [Room('Room %d.' % i) for i in range(5)]
+    for a, b in zip(rooms, rooms[1:]):
+        a.east = b
+    lonely = Room('Nowhere.')
+    assert rooms[0].path_to(rooms[0]) == []
+    assert rooms[0].path_to(rooms[3]) == ['east'] * 3
+    assert rooms[4].path_to(rooms[2]) == ['west', 'west']
+    assert rooms[0].path_to(lonely) is None
+
+    rooms[0].north = rooms[3]
+    assert rooms[0].path_to(rooms[4]) == ['north', 'east']
+    rooms[0].north = None  # rooms[3].south still leads to rooms[0]
+    assert rooms[0].path_to(rooms[4]) == ['east'] * 4
+    assert rooms[3].path_to(rooms[0]) == ['south']
+
+
+def test_routes_cache():
+    """Routes keeps searches until a room they reached changes."""
+    routes = adventurelib.Routes()
+    try:
+        a, b, c, other = (adventurelib.CompactRoom(d) for d in 'abcd')
+        a.north = b
+        b.north = c
+        assert routes.paths([(a, c), (a, b), (c, a)]) == [
+            ['north', 'north'], ['north'], ['south', 'south']
+        ]
+        assert routes.cache_info().currsize == 2
+        other.east = Room('Elsewhere.')
+        assert routes.cache_info().currsize == 2
+        c.east = other
+        assert routes.cache_info().currsize == 0
+        assert routes.distance(a, other) == 3
+    finally:
+        routes.close()
+
+
+def test_routes_do_not_keep_rooms_alive():
+    """Cached routes are freed with their rooms, and Routes with its users."""
+    gc.collect()
+    cached = adventurelib.routes.cache_info().currsize
+    routes = adventurelib.Routes()
+    a, b = adventurelib.CompactRoom('a'), Room('b')
+    a.north = b
+    assert routes.path(a, b) == ['north']
+    assert adventurelib.routes.path(a, b) == ['north']
+    room_ref = weakref.ref(b)
+    routes_ref = weakref.ref(routes)
+    del a, b, routes
+    gc.collect()
+    assert room_ref() is None
+    assert routes_ref() is None
+    assert adventurelib.routes.cache_info().currsize == cached
+
+
+WORLD = """\
+# A small world
+direction ascend descend
+direction north south
+
+room cave
+    You are in a dark cave.
+    Water drips from the ceiling.
+exit cave ascend valley
+room valley
+    You are in a beautiful valley.
+item mallet rusty mallet, mallet
+item lamp Lamp
+bag inventory
+put mallet valley
+put lamp inventory
+"""
+
+
+def test_star_import():
+    """Functions that games call are exported by ``import *``."""
+    names = {}
+    exec('from adventurelib import *', names)
+    assert {
+        'serve', 'create_server', 'load_test',
+        'respond', 'respond_stream', 'record', 'replay', 'replay_all',
+        'load_world', 'World', 'InvalidWorld',
+    } <= names.keys()
+
+
+def test_load_world():
+    """Worlds can be loaded from a file, with exits to rooms defined later."""
+    world = adventurelib.load_world(StringIO(WORLD))
+    cave, valley = world.rooms['cave'], world.rooms['valley']
+    assert str(cave) == (
+        'You are in a dark cave.\nWater drips from the ceiling.'
+    )
+    assert cave.ascend is valley and valley.descend is cave
+    assert 'mallet' in valley.items
+    assert world.items['lamp'] in world.bags['inventory']
+    assert world.records == 10
+    assert world.records_per_second > 0
+
+
+def test_load_world_compact(tmpdir):
+    """Worlds can be loaded from a path into compact rooms."""
+    path = tmpdir.join('world.txt')
+    path.write('room a\n    A.\nroom b\n    B.\nexit a east b\n')
+    world = adventurelib.load_world(
+        str(path), adventurelib.CompactRoom, adventurelib.CompactItem
+    )
+    assert world.rooms['a'].path_to(world.rooms['b']) == ['east']
+
+
+@pytest.mark.parametrize('text, error', [
+    ('exit a north b\n', "line 1: unknown room 'a'"),
+    ('room a\n    A.\nexit a sideways a\n', "line 3: 'sideways' is not a"),
+    ('put rock a\n', "line 1: unknown item 'rock'"),
+    ('    Floating.\n', 'line 1: description outside a room'),
+    ('teleport a b\n', "line 1: unknown record 'teleport'"),
+    ('item rock Rock\nitem rock Stone\n', "line 2: item 'rock' is already"),
+    ('bag sack\nbag sack\n', "line 2: bag 'sack' is already"),
+])
+def test_load_world_errors(text, error):
+    """Mistakes in world files are reported with their line number."""
+    with pytest.raises(adventurelib.InvalidWorld) as exc:
+        adventurelib.load_world(StringIO(text))
+    assert str(exc.value).startswith(error)
+
+
+def test_load_world_compact_items():
+    """Putting items in rooms that can't hold them is reported."""
+    with pytest.raises(adventurelib.InvalidWorld) as exc:
+        adventurelib.load_world(
+            StringIO('room a\n    A.\nitem rock Rock\nput rock a\n'),
+            adventurelib.CompactRoom
+        )
+    assert str(exc.value) == "line 4: room 'a' cannot hold items"
+
+
+def test_compact_room_exits():
+    """CompactRooms link to each other, and to Rooms, in both directions."""
+    hall = adventurelib.CompactRoom('A hall.')
+    kitchen = adventurelib.CompactRoom('A kitchen.')
+    garden = Room('A garden.')
+    hall.east = kitchen
+    garden.north = hall
+    assert hall.exits() == ['east', 'south']
+    assert kitchen.exit('west') is hall
+    assert hall.exit('south') is garden
+    assert hall.west is None
+    hall.east = None
+    assert hall.exits() == ['south']
+    with pytest.raises(adventurelib.InvalidDirection):
+        hall.up = kitchen
+    with pytest.raises(AttributeError):
+        hall.smell = 'musty'
+
+
+def test_compact_item():
+    """CompactItems can be found in Bags by their aliases."""
+    rock = adventurelib.CompactItem('Rock', 'stone')
+    bag = Bag([rock])
+    assert 'stone' in bag
+    assert bag.take('rock') is rock
+    assert not hasattr(rock, '__dict__')
+
+
+def world_memory(room_cls, item_cls, n=5000):
+    """Return the bytes allocated to build a world of n rooms and items."""
+    import tracemalloc
+    gc.collect()
+    gc.disable()
+    tracemalloc.start()
+    try:
+        rooms = [room_cls('A room.') for _ in range(n)]
+        for a, b in zip(rooms, rooms[1:]):
+            a.north = b
+        items = [item_cls('rock', 'stone') for _ in range(n)]  # noqa
+        return tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+        gc.enable()
+
+
+def test_compact_memory():
+    """CompactRoom and CompactItem use much less memory than Room and Item."""
+    regular = world_memory(Room, Item)
+    compact = world_memory(adventurelib.CompactRoom, adventurelib.CompactItem)
+    assert compact < regular * 0.75
+
+
 @patch('random.randrange', return_value=0)
 def test_bag_get_random(randrange):
     """We can select an item from a bag at random."""